@@ -1,4 +1,8 @@
 #!/bin/sh
 
 python /opt/stuart/stuart.py --create-db
-gunicorn -b $STUART_HOST:$STUART_PORT stuart:gapp
+if [ -z "$STUART_DB_URI" ] && [ -z "$STUART_DB_URI_FILE" ]; then
+    # the default in-memory database cannot be shared by worker processes
+    exec python /opt/stuart/stuart.py --workers 0
+fi
+exec python /opt/stuart/stuart.py --workers ${STUART_WORKERS:-2}
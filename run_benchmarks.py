@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import sqlalchemy
+
+import stuart
+from stuart import app
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.count += 1
+
+
+def make_content(rng, size, page_count):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+             'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor']
+    parts = []
+    length = 0
+    while length < size:
+        kind = rng.randrange(4)
+        if kind == 0:
+            part = '## ' + ' '.join(rng.choice(words) for _ in range(4))
+        elif kind == 1:
+            part = '\n'.join('* ' + ' '.join(rng.choice(words)
+                                             for _ in range(6))
+                             for _ in range(4))
+        elif kind == 2:
+            part = 'See [page {0}](/page/page-{0}) for more.'.format(
+                rng.randrange(page_count))
+        else:
+            part = ' '.join(rng.choice(words) for _ in range(60))
+        parts.append(part)
+        length += len(part) + 2
+    return '\n\n'.join(parts)[:size]
+
+
+def seed(pages, tags, links, content_size, chunk_size=500):
+    rng = random.Random(2512)
+    tag_names = ['tag-{}'.format(i) for i in range(tags)]
+    start = datetime(2017, 1, 1)
+    records = []
+    for i in range(pages):
+        date = start + timedelta(hours=i)
+        records.append({
+            'title': 'Page {}'.format(i),
+            'content': make_content(rng, content_size, pages),
+            'notes': make_content(rng, content_size // 10, pages),
+            'date': date.isoformat(),
+            'last_updated_date': date.isoformat(),
+            'is_private': i % 10 == 9,
+            'tags': rng.sample(tag_names, min(links, len(tag_names))),
+        })
+    for chunk in stuart.chunked(records, chunk_size):
+        stuart.import_page_chunk(chunk)
+        app.db.session.commit()
+    app.db.session.add(stuart.Option('main_page', 'Page 0'))
+    user = stuart.User(email='bench@example.com', hashed_password='x')
+    app.db.session.add(user)
+    app.db.session.commit()
+    return user.id
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def deferred_bytes(html):
+    # the listing pages load only the listing columns; report how many
+    # bytes of content and notes that avoids for the pages shown
+    slugs = [slug for slug, in app.db.session.query(stuart.Page.slug)
+             if '/page/{}"'.format(slug) in html]
+    total = 0
+    for chunk in stuart.chunked(slugs, 500):
+        total += app.db.session.query(sqlalchemy.func.sum(
+            sqlalchemy.func.length(stuart.Page._content) +
+            sqlalchemy.func.coalesce(
+                sqlalchemy.func.length(stuart.Page.notes), 0))).filter(
+            stuart.Page.slug.in_(chunk)).scalar() or 0
+    return total
+
+
+def summarize(latencies):
+    return {
+        'min': min(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+    }
+
+
+def measure_startup(runs):
+    # import the module in a fresh interpreter each time, as a worker or a
+    # command would
+    script = ('import time; start = time.perf_counter(); import stuart; '
+              'print((time.perf_counter() - start) * 1000)')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-W', 'ignore', '-c', script], cwd=directory,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        latencies.append(float(output.stdout.split()[-1]))
+    return {
+        'runs': runs,
+        'latency_ms': summarize(latencies),
+    }
+
+
+def measure(counter, requests):
+    latencies = []
+    queries = []
+    sizes = []
+    for send in requests:
+        counter.count = 0
+        start = time.perf_counter()
+        response = send()
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count)
+        sizes.append(len(response.data))
+        if response.status_code >= 400:
+            raise Exception('Request failed with status {}'.format(
+                response.status_code))
+    return {
+        'requests': len(latencies),
+        'latency_ms': summarize(latencies),
+        'queries_per_request': statistics.mean(queries),
+        'response_bytes': statistics.mean(sizes),
+    }, response
+
+
+def run_benchmarks(args):
+    results = {}
+    if not args.only or 'startup' in args.only:
+        results['startup'] = measure_startup(args.startup_runs)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db_uri
+    app.config['TESTING'] = True
+    stuart.response_cache = None
+    with app.app_context():
+        app.db.drop_all()
+        stuart.get_search_index().drop()
+        app.db.create_all()
+        stuart.get_search_index().create()
+        app.db.session.commit()
+
+    start = time.perf_counter()
+    user_id = seed(args.pages, args.tags, args.links, args.content_size)
+    seed_time = time.perf_counter() - start
+
+    rng = random.Random(2512)
+    public_slugs = [slug for slug, in app.db.session.query(
+        stuart.Page.slug).filter(stuart.Page.is_private.is_(False))]
+    tag_ids = [tag_id for tag_id, in app.db.session.query(stuart.Tag.id)]
+    anon = app.test_client()
+    auth = app.test_client()
+    with auth.session_transaction() as session:
+        session['_user_id'] = user_id
+
+    def get(client, path):
+        return lambda: client.get(path)
+
+    n = args.requests
+    benchmarks = {
+        'index': [get(anon, '/') for _ in range(n)],
+        'page': [get(anon, '/page/{}'.format(rng.choice(public_slugs)))
+                 for _ in range(n)],
+        'page_authenticated': [
+            get(auth, '/page/{}'.format(rng.choice(public_slugs)))
+            for _ in range(n)],
+        'all_pages': [get(anon, '/all-pages') for _ in range(n)],
+        'list_tags': [get(anon, '/tags') for _ in range(n)],
+        'get_tag': [get(anon, '/tags/{}'.format(rng.choice(tag_ids)))
+                    for _ in range(n)],
+        'edit_page': [
+            (lambda i: lambda: auth.post(
+                '/edit/{}'.format(public_slugs[i % len(public_slugs)]),
+                data={'title': 'Page {}'.format(i % len(public_slugs)),
+                      'content': make_content(rng, args.content_size,
+                                              args.pages),
+                      'notes': '',
+                      'tags': ','.join(rng.sample(
+                          ['tag-{}'.format(t) for t in range(args.tags)],
+                          min(args.links, args.tags)))}))(i)
+            for i in range(n)],
+        'create_new': [
+            (lambda i: lambda: auth.post('/new', data={
+                'title': 'New page {}'.format(i),
+                'content': make_content(rng, args.content_size, args.pages),
+                'notes': '',
+                'tags': 'tag-0'}))(i)
+            for i in range(n)],
+    }
+    if args.only:
+        benchmarks = {name: requests for name, requests in benchmarks.items()
+                      if name in args.only}
+
+    counter = QueryCounter()
+    engine = app.db.engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        for name, requests in benchmarks.items():
+            for send in requests[:args.warmup]:
+                send()
+            result, response = measure(counter, requests)
+            if name in ('all_pages', 'get_tag'):
+                result['deferred_bytes_per_request'] = deferred_bytes(
+                    response.get_data(as_text=True))
+            results[name] = result
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', counter)
+
+    return {
+        'version': stuart.__version__,
+        'revision': stuart.__revision__,
+        'python': sys.version.split()[0],
+        'parameters': {
+            'db_uri': args.db_uri,
+            'pages': args.pages,
+            'tags': args.tags,
+            'links': args.links,
+            'content_size': args.content_size,
+            'requests': args.requests,
+            'startup_runs': args.startup_runs,
+        },
+        'seed_seconds': seed_time,
+        'results': results,
+    }
+
+
+def compare(baseline, current):
+    lines = ['{:20} {:>12} {:>12} {:>8} {:>10} {:>10}'.format(
+        'benchmark', 'base p50 ms', 'p50 ms', 'change', 'base q/req',
+        'q/req')]
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        base_p50 = base['latency_ms']['p50']
+        p50 = result['latency_ms']['p50']
+        lines.append('{:20} {:12.2f} {:12.2f} {:+7.1f}% {:10.1f} {:10.1f}'
+                     .format(name, base_p50, p50,
+                             (p50 - base_p50) / base_p50 * 100,
+                             base.get('queries_per_request', 0),
+                             result.get('queries_per_request', 0)))
+    return '\n'.join(lines)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Measure latency and queries per request for the hot '
+                    'request paths, and print the results as JSON.')
+    parser.add_argument('--db-uri', type=str, default='sqlite://',
+                        help='The database to seed. It is emptied first.')
+    parser.add_argument('--pages', type=int, default=1000,
+                        help='The number of pages to create.')
+    parser.add_argument('--tags', type=int, default=100,
+                        help='The number of distinct tags to create.')
+    parser.add_argument('--links', type=int, default=3,
+                        help='The number of tags to attach to each page.')
+    parser.add_argument('--content-size', type=int, default=20000,
+                        help='The length of each page\'s content, in '
+                             'characters.')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='The number of requests to time per '
+                             'benchmark.')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='The number of untimed requests to send before '
+                             'each benchmark.')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='The number of times to time importing the '
+                             'module in a new interpreter.')
+    parser.add_argument('--only', action='append', metavar='BENCHMARK',
+                        help='Only run the named benchmark. May be given '
+                             'more than once.')
+    parser.add_argument('--output', type=str, metavar='FILE',
+                        help='Write the results to a file instead of '
+                             'stdout.')
+    parser.add_argument('--compare', type=str, metavar='BASELINE',
+                        help='Print a comparison with the results in a '
+                             'previous output file.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    run()
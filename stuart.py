@@ -20,19 +20,46 @@
 
 
 import argparse
+import atexit
+import base64
+import bisect
+from collections import OrderedDict
 from datetime import datetime
+from datetime import timezone
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+from html.parser import HTMLParser
 from itertools import cycle
+from itertools import islice
+import json
+import math
+import multiprocessing
+import os
 from os import environ
 import random
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import unquote
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
 
 import dateutil.parser
 from flask import flash
 from flask import Flask
+from flask import g
+from flask import has_request_context
+from flask import make_response
 from flask import Markup
 from flask import redirect
-from flask import render_template
+from flask import render_template as flask_render_template
 from flask import request
+from flask import Response
 from flask import url_for
 from flask_bcrypt import Bcrypt
 from flask_login import current_user
@@ -45,23 +72,46 @@ import gfm  # noqa: F401
 import jinja2
 import markdown
 from slugify import slugify
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 from werkzeug.exceptions import BadRequest
 from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.exceptions import TooManyRequests
 from werkzeug.exceptions import Unauthorized
 from werkzeug.serving import run_simple
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 __version__ = '0.7'
-try:
-    import git
 
+
+@functools.lru_cache(maxsize=None)
+def get_revision():
+    if Config.REVISION:
+        return Config.REVISION
+    try:
+        import git
+    except ImportError:
+        return 'unknown'
     try:
-        __revision__ = git.Repo('.').git.describe(tags=True, dirty=True,
-                                                  always=True, abbrev=40)
-    except git.InvalidGitRepositoryError:
-        __revision__ = 'unknown'
-except ImportError:
-    __revision__ = 'unknown'
+        return git.Repo('.').git.describe(tags=True, dirty=True, always=True,
+                                          abbrev=40)
+    except git.GitError:
+        return 'unknown'
+
+
+def __getattr__(name):
+    # look the revision up on first use rather than on import, which would
+    # start a git subprocess in every worker and command
+    if name == '__revision__':
+        return get_revision()
+    raise AttributeError(
+        "module '{}' has no attribute '{}'".format(__name__, name))
 
 
 class StuartError(Exception):
@@ -84,6 +134,45 @@ class Config(object):
     CUSTOM_TEMPLATES = environ.get('STUART_CUSTOM_TEMPLATES', None)
     AUTHOR = environ.get('STUART_AUTHOR', 'The Author')
     LOCAL_RESOURCES = environ.get('STUART_LOCAL_RESOURCES', False)
+    RENDER_CACHE_SIZE = int(environ.get('STUART_RENDER_CACHE_SIZE', 256))
+    OPTIONS_CACHE_TTL = float(environ.get('STUART_OPTIONS_CACHE_TTL', 30))
+    USER_CACHE_TTL = float(environ.get('STUART_USER_CACHE_TTL', 60))
+    BCRYPT_ROUNDS = int(environ.get('STUART_BCRYPT_ROUNDS', 12))
+    LOGIN_CONCURRENCY = int(environ.get('STUART_LOGIN_CONCURRENCY', 2))
+    LOGIN_RATE_LIMIT = int(environ.get('STUART_LOGIN_RATE_LIMIT', 10))
+    LOGIN_RATE_WINDOW = float(environ.get('STUART_LOGIN_RATE_WINDOW', 60))
+    PROXY_COUNT = int(environ.get('STUART_PROXY_COUNT', 0))
+    COUNT_PAGES = environ.get('STUART_COUNT_PAGES', False)
+    SEARCH_BACKEND = environ.get('STUART_SEARCH_BACKEND', 'auto')
+    PAGE_MAX_AGE = int(environ.get('STUART_PAGE_MAX_AGE', 60))
+    RESPONSE_CACHE = environ.get('STUART_RESPONSE_CACHE', 'none')
+    RESPONSE_CACHE_DIR = environ.get('STUART_RESPONSE_CACHE_DIR', None)
+    RESPONSE_CACHE_MAX_BYTES = int(environ.get(
+        'STUART_RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    RESPONSE_CACHE_TTL = float(environ.get('STUART_RESPONSE_CACHE_TTL', 60))
+    JOBS = int(environ.get('STUART_JOBS', os.cpu_count() or 1))
+    JOB_THREADS = int(environ.get('STUART_JOB_THREADS', 2))
+    INSTRUMENT = environ.get('STUART_INSTRUMENT', False)
+    SLOW_REQUEST_MS = float(environ.get('STUART_SLOW_REQUEST_MS', 500))
+    METRICS = environ.get('STUART_METRICS', False)
+    METRICS_DIR = environ.get('STUART_METRICS_DIR', None)
+    WORKERS = int(environ.get('STUART_WORKERS', 0))
+    THREADS = int(environ.get('STUART_THREADS', 1))
+    KEEPALIVE = int(environ.get('STUART_KEEPALIVE', 5))
+    BACKLOG = int(environ.get('STUART_BACKLOG', 2048))
+    GRACEFUL_TIMEOUT = int(environ.get('STUART_GRACEFUL_TIMEOUT', 30))
+    REVISION = environ.get('STUART_REVISION', None)
+    PRODUCTION = environ.get('STUART_PRODUCTION', False)
+    TEMPLATE_CACHE_DIR = environ.get('STUART_TEMPLATE_CACHE_DIR', None)
+    DB_POOL_SIZE = int(environ.get('STUART_DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(environ.get('STUART_DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = float(environ.get('STUART_DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(environ.get('STUART_DB_POOL_RECYCLE', -1))
+    DB_POOL_PRE_PING = environ.get('STUART_DB_POOL_PRE_PING', False)
+    DB_STATEMENT_TIMEOUT = int(environ.get('STUART_DB_STATEMENT_TIMEOUT', 0))
+    SQLITE_WAL = environ.get('STUART_SQLITE_WAL', False)
+    SQLITE_MMAP_SIZE = int(environ.get('STUART_SQLITE_MMAP_SIZE',
+                                       256 * 1024 * 1024))
 
 
 if __name__ == "__main__":
@@ -120,16 +209,243 @@ if __name__ == "__main__":
                         default=Config.LOCAL_RESOURCES,
                         help='Use local resources (CSS and JS served from the '
                              'app instead of from global URLs).')
+    parser.add_argument('--render-cache-size', type=int,
+                        default=Config.RENDER_CACHE_SIZE,
+                        help='The maximum number of rendered markdown '
+                             'fragments to keep in memory.')
+    parser.add_argument('--options-cache-ttl', type=float,
+                        default=Config.OPTIONS_CACHE_TTL,
+                        help='The number of seconds to keep options loaded '
+                             'from the database. Changes made with '
+                             '--set-option or --clear-option take up to this '
+                             'long to appear on a running server. Set to 0 '
+                             'to load them once per request.')
+    parser.add_argument('--user-cache-ttl', type=float,
+                        default=Config.USER_CACHE_TTL,
+                        help='The number of seconds to keep logged-in users '
+                             'in memory instead of loading them on every '
+                             'request. Set to 0 to load them every time.')
+    parser.add_argument('--bcrypt-rounds', type=int,
+                        default=Config.BCRYPT_ROUNDS,
+                        help='The bcrypt work factor for new password '
+                             'hashes. Each step doubles the time taken. '
+                             'Passwords hashed with another factor are '
+                             'rehashed when their user next logs in. See '
+                             '--benchmark-hash.')
+    parser.add_argument('--login-concurrency', type=int,
+                        default=Config.LOGIN_CONCURRENCY,
+                        help='The number of password checks that may run at '
+                             'once in each process, so that logins cannot '
+                             'occupy every thread. Logins beyond this are '
+                             'refused at once. Set to 0 for no limit.')
+    parser.add_argument('--login-rate-limit', type=int,
+                        default=Config.LOGIN_RATE_LIMIT,
+                        help='The number of login attempts allowed from one '
+                             'address in --login-rate-window seconds. Set '
+                             'to 0 for no limit.')
+    parser.add_argument('--login-rate-window', type=float,
+                        default=Config.LOGIN_RATE_WINDOW,
+                        help='The period in seconds over which login '
+                             'attempts are counted.')
+    parser.add_argument('--proxy-count', type=int,
+                        default=Config.PROXY_COUNT,
+                        help='The number of reverse proxies in front of the '
+                             'server. Client addresses, which the login '
+                             'rate limit is counted by, are then taken from '
+                             'the X-Forwarded-For header that they set. Set '
+                             'this for proxied deployments, where otherwise '
+                             'all clients share the proxy\'s address and '
+                             'limit. Leave at 0 when clients connect '
+                             'directly, or they could choose their own '
+                             'address.')
+    parser.add_argument('--count-pages', action='store_true',
+                        default=Config.COUNT_PAGES,
+                        help='Show the total number of pages in paginated '
+                             'listings. This costs a COUNT query on every '
+                             'view.')
+    parser.add_argument('--search-backend', type=str,
+                        default=Config.SEARCH_BACKEND,
+                        choices=['auto', 'sqlite', 'postgresql', 'python'],
+                        help='The full-text search index to use. "auto" '
+                             'picks the native index of the database, or '
+                             '"python" for other databases.')
+    parser.add_argument('--page-max-age', type=int,
+                        default=Config.PAGE_MAX_AGE,
+                        help='The number of seconds that browsers and '
+                             'proxies may cache public pages for anonymous '
+                             'users.')
+    parser.add_argument('--response-cache', type=str,
+                        default=Config.RESPONSE_CACHE,
+                        choices=['none', 'memory', 'filesystem'],
+                        help='Cache whole responses for anonymous users, '
+                             'either in the memory of each process or in a '
+                             'directory shared by all processes. The memory '
+                             'cache is only invalidated in the process that '
+                             'made a change, so use it with a single '
+                             'process; with --workers, other processes and '
+                             'commands such as --set-option leave stale '
+                             'responses for up to --response-cache-ttl '
+                             'seconds.')
+    parser.add_argument('--response-cache-dir', type=str,
+                        default=Config.RESPONSE_CACHE_DIR,
+                        help='The directory to use for the filesystem '
+                             'response cache.')
+    parser.add_argument('--response-cache-ttl', type=float,
+                        default=Config.RESPONSE_CACHE_TTL,
+                        help='The number of seconds to keep a response in '
+                             'the response cache. Set to 0 to keep '
+                             'responses until they are invalidated or '
+                             'evicted.')
+    parser.add_argument('--response-cache-max-bytes', type=int,
+                        default=Config.RESPONSE_CACHE_MAX_BYTES,
+                        help='The maximum total size of responses to keep '
+                             'in the response cache. The filesystem cache '
+                             'is trimmed to this size every minute, or '
+                             'sooner after a quarter of it has been '
+                             'written.')
+    parser.add_argument('--jobs', type=int, default=Config.JOBS,
+                        help='The number of processes to use for bulk '
+                             'commands such as --export-static.')
+    parser.add_argument('--job-threads', type=int,
+                        default=Config.JOB_THREADS,
+                        help='The number of threads in each server process '
+                             'that render and index pages after they are '
+                             'saved. Set to 0 to do that work in the '
+                             'request that saves the page.')
+    parser.add_argument('--instrument', action='store_true',
+                        default=Config.INSTRUMENT,
+                        help='Record the number of queries and the time '
+                             'spent in the database, markdown and templates '
+                             'for each request, and report them in a '
+                             'Server-Timing header.')
+    parser.add_argument('--slow-request-ms', type=float,
+                        default=Config.SLOW_REQUEST_MS,
+                        help='With --instrument, log requests that take at '
+                             'least this many milliseconds.')
+    parser.add_argument('--metrics', action='store_true',
+                        default=Config.METRICS,
+                        help='Serve request, database, markdown, login and '
+                             'cache metrics at /metrics in the Prometheus '
+                             'text format.')
+    parser.add_argument('--metrics-dir', type=str,
+                        default=Config.METRICS_DIR,
+                        help='A directory shared by all worker processes, '
+                             'in which each process keeps a snapshot of its '
+                             'metrics, so that /metrics reports the totals '
+                             'of all processes. It should be emptied before '
+                             'the server starts.')
+    parser.add_argument('--workers', type=int, default=Config.WORKERS,
+                        help='Serve requests with this many worker '
+                             'processes, using gunicorn. The default of 0 '
+                             'uses the single-process development server. '
+                             'Send SIGHUP to the main process to restart '
+                             'the workers gracefully.')
+    parser.add_argument('--threads', type=int, default=Config.THREADS,
+                        help='With --workers, the number of threads per '
+                             'worker process.')
+    parser.add_argument('--keepalive', type=int, default=Config.KEEPALIVE,
+                        help='With --workers and --threads, the number of '
+                             'seconds to wait for another request on a '
+                             'keep-alive connection.')
+    parser.add_argument('--backlog', type=int, default=Config.BACKLOG,
+                        help='With --workers, the maximum number of '
+                             'connections waiting to be accepted.')
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=Config.GRACEFUL_TIMEOUT,
+                        help='With --workers, the number of seconds that '
+                             'workers have to finish their requests when '
+                             'restarting or stopping.')
+    parser.add_argument('--revision', type=str, default=Config.REVISION,
+                        help='The revision to report, for example as baked '
+                             'in when building an image. If none is '
+                             'specified, it is looked up with git when first '
+                             'needed.')
+    parser.add_argument('--production', action='store_true',
+                        default=Config.PRODUCTION,
+                        help='Do not check template files for changes, '
+                             'keep compiled templates in a bytecode cache on '
+                             'disk, and compile all templates before '
+                             'serving.')
+    parser.add_argument('--template-cache-dir', type=str,
+                        default=Config.TEMPLATE_CACHE_DIR,
+                        help='With --production, the directory in which to '
+                             'keep compiled templates. It may be shared by '
+                             'all worker processes. Defaults to a directory '
+                             'in the system temporary directory.')
+    parser.add_argument('--db-pool-size', type=int,
+                        default=Config.DB_POOL_SIZE,
+                        help='The number of connections to keep open in '
+                             'each process. Not used with SQLite.')
+    parser.add_argument('--db-max-overflow', type=int,
+                        default=Config.DB_MAX_OVERFLOW,
+                        help='The number of connections to open beyond '
+                             '--db-pool-size when all are in use. Not used '
+                             'with SQLite.')
+    parser.add_argument('--db-pool-timeout', type=float,
+                        default=Config.DB_POOL_TIMEOUT,
+                        help='The number of seconds to wait for a free '
+                             'connection. Not used with SQLite.')
+    parser.add_argument('--db-pool-recycle', type=int,
+                        default=Config.DB_POOL_RECYCLE,
+                        help='Replace connections older than this many '
+                             'seconds. Set it below the server\'s idle '
+                             'timeout. -1 never replaces them. Not used with '
+                             'SQLite.')
+    parser.add_argument('--db-pool-pre-ping', action='store_true',
+                        default=Config.DB_POOL_PRE_PING,
+                        help='Test each connection before use, and replace '
+                             'it if the server has closed it. Not used with '
+                             'SQLite.')
+    parser.add_argument('--db-statement-timeout', type=int,
+                        default=Config.DB_STATEMENT_TIMEOUT,
+                        help='Cancel statements that run for longer than '
+                             'this many milliseconds. 0 disables the '
+                             'timeout. PostgreSQL only.')
+    parser.add_argument('--sqlite-wal', action='store_true',
+                        default=Config.SQLITE_WAL,
+                        help='Open SQLite databases in write-ahead log mode '
+                             'with synchronous=NORMAL and memory-mapped I/O, '
+                             'so that readers do not block the writer.')
+    parser.add_argument('--sqlite-mmap-size', type=int,
+                        default=Config.SQLITE_MMAP_SIZE,
+                        help='With --sqlite-wal, the number of bytes of the '
+                             'database file to memory-map.')
 
     parser.add_argument('--create-secret-key', action='store_true')
     parser.add_argument('--create-db', action='store_true')
     parser.add_argument('--hash-password', action='store', metavar='PASSWORD')
+    parser.add_argument('--benchmark-hash', action='store', type=float,
+                        nargs='?', const=250, metavar='MS',
+                        help='Time password hashing at increasing work '
+                             'factors, and suggest the largest one that '
+                             'takes no longer than MS milliseconds (default '
+                             '250).')
     parser.add_argument('--reset-slug', action='store', metavar='PAGE_ID')
     parser.add_argument('--set-date', action='store', nargs=2,
                         metavar=('PAGE_ID', 'DATE'))
     parser.add_argument('--set-last-updated-date', action='store', nargs=2,
                         metavar=('PAGE_ID', 'DATE'))
     parser.add_argument('--reset-summary', action='store', metavar='PAGE_ID')
+    parser.add_argument('--reset-all-summaries', action='store_true',
+                        help='Recompute the summaries of all pages, in '
+                             'batches spread over --jobs processes.')
+    parser.add_argument('--warm-render-cache', action='store_true',
+                        help='Render the content and notes of all pages and '
+                             'store the resulting HTML in the database.')
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help='Drop the full-text search index and re-index '
+                             'all pages.')
+    parser.add_argument('--rebuild-links', action='store_true',
+                        help='Find the links between pages in the content '
+                             'of all pages, for example after '
+                             '--import-pages.')
+    parser.add_argument('--list-jobs', action='store_true',
+                        help='List the background jobs that are waiting, '
+                             'running or have failed.')
+    parser.add_argument('--drain-jobs', action='store_true',
+                        help='Run all waiting and failed background jobs, '
+                             'and any that have been running for too long, '
+                             'then exit.')
     parser.add_argument('--list-options', action='store', nargs='?',
                         metavar='SEARCH_TERM', const='')
     parser.add_argument('--set-option', action='store', nargs=2,
@@ -138,6 +454,21 @@ if __name__ == "__main__":
     parser.add_argument('--create-user', metavar=('EMAIL', 'PASSWORD'),
                         nargs=2, help='Create a user with the indicated '
                                       'email address and password')
+    parser.add_argument('--export-static', action='store', metavar='DIR',
+                        help='Render all public pages and tags to static '
+                             'HTML files in the indicated directory.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='With --export-static, only re-render pages '
+                             'that changed since the last export.')
+    parser.add_argument('--export-pages', action='store', metavar='FILE',
+                        help='Write all pages, tags and options to a '
+                             'JSON-lines file.')
+    parser.add_argument('--import-pages', action='store', metavar='FILE',
+                        help='Add the pages, tags and options in a JSON-lines '
+                             'file written by --export-pages.')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='The number of records to read or write at a '
+                             'time with --export-pages and --import-pages.')
 
     args = parser.parse_args()
 
@@ -158,6 +489,43 @@ if __name__ == "__main__":
     Config.CUSTOM_TEMPLATES = args.custom_templates
     Config.AUTHOR = args.author
     Config.LOCAL_RESOURCES = args.local_resources
+    Config.RENDER_CACHE_SIZE = args.render_cache_size
+    Config.OPTIONS_CACHE_TTL = args.options_cache_ttl
+    Config.USER_CACHE_TTL = args.user_cache_ttl
+    Config.BCRYPT_ROUNDS = args.bcrypt_rounds
+    Config.LOGIN_CONCURRENCY = args.login_concurrency
+    Config.LOGIN_RATE_LIMIT = args.login_rate_limit
+    Config.LOGIN_RATE_WINDOW = args.login_rate_window
+    Config.PROXY_COUNT = args.proxy_count
+    Config.COUNT_PAGES = args.count_pages
+    Config.SEARCH_BACKEND = args.search_backend
+    Config.PAGE_MAX_AGE = args.page_max_age
+    Config.RESPONSE_CACHE = args.response_cache
+    Config.RESPONSE_CACHE_DIR = args.response_cache_dir
+    Config.RESPONSE_CACHE_MAX_BYTES = args.response_cache_max_bytes
+    Config.RESPONSE_CACHE_TTL = args.response_cache_ttl
+    Config.JOBS = args.jobs
+    Config.JOB_THREADS = args.job_threads
+    Config.INSTRUMENT = args.instrument
+    Config.SLOW_REQUEST_MS = args.slow_request_ms
+    Config.METRICS = args.metrics
+    Config.METRICS_DIR = args.metrics_dir
+    Config.WORKERS = args.workers
+    Config.THREADS = args.threads
+    Config.KEEPALIVE = args.keepalive
+    Config.BACKLOG = args.backlog
+    Config.GRACEFUL_TIMEOUT = args.graceful_timeout
+    Config.REVISION = args.revision
+    Config.PRODUCTION = args.production
+    Config.TEMPLATE_CACHE_DIR = args.template_cache_dir
+    Config.DB_POOL_SIZE = args.db_pool_size
+    Config.DB_MAX_OVERFLOW = args.db_max_overflow
+    Config.DB_POOL_TIMEOUT = args.db_pool_timeout
+    Config.DB_POOL_RECYCLE = args.db_pool_recycle
+    Config.DB_POOL_PRE_PING = args.db_pool_pre_ping
+    Config.DB_STATEMENT_TIMEOUT = args.db_statement_timeout
+    Config.SQLITE_WAL = args.sqlite_wal
+    Config.SQLITE_MMAP_SIZE = args.sqlite_mmap_size
 
 app = Flask(__name__)
 
@@ -167,7 +535,41 @@ if Config.CUSTOM_TEMPLATES:
         app.jinja_loader])
     app.jinja_loader = loader
 
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+
+def atomic_write(path, data):
+    # write to a temporary file in the same directory and rename it into
+    # place, so that other processes never read a partially written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class AtomicBytecodeCache(jinja2.FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        atomic_write(self._get_cache_filename(bucket),
+                     bucket.bytecode_to_string())
+
+
+if Config.PRODUCTION:
+    # the environment is created on first use, which is when the template
+    # filters below are registered, so its options must be set by then
+    if Config.TEMPLATE_CACHE_DIR:
+        os.makedirs(Config.TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_options = dict(
+        app.jinja_options,
+        bytecode_cache=AtomicBytecodeCache(Config.TEMPLATE_CACHE_DIR))
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+else:
+    app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config["SECRET_KEY"] = Config.SECRET_KEY  # for WTF-forms and login
 
 db_uri = 'sqlite://'
@@ -189,6 +591,28 @@ elif Config.DB_URI_FILE:
             f'Error opening uri file "{Config.DB_URI_FILE}": {e}')
 app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
 
+
+def get_engine_options(uri):
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        # flask-sqlalchemy picks the pool for sqlite: one shared connection
+        # for an in-memory database, and none kept for a file
+        return {}
+    options = {
+        'pool_size': Config.DB_POOL_SIZE,
+        'max_overflow': Config.DB_MAX_OVERFLOW,
+        'pool_timeout': Config.DB_POOL_TIMEOUT,
+        'pool_recycle': Config.DB_POOL_RECYCLE,
+        'pool_pre_ping': bool(Config.DB_POOL_PRE_PING),
+    }
+    if Config.DB_STATEMENT_TIMEOUT and url.drivername.startswith('postgres'):
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(
+            Config.DB_STATEMENT_TIMEOUT)}
+    return options
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(db_uri)
+
 app.config['APPLICATION_ROOT'] = Config.PATH_PREFIX
 
 # extensions
@@ -196,13 +620,16 @@ login_manager = LoginManager(app)
 login_manager.init_app(app)
 db = SQLAlchemy(app)
 app.db = db
+app.config['BCRYPT_LOG_ROUNDS'] = Config.BCRYPT_ROUNDS
 bcrypt = Bcrypt(app)
 
 
 tags_table = db.Table(
     'tags_pages',
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), index=True),
-    db.Column('page_id', db.Integer, db.ForeignKey('page.id'), index=True))
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'),
+              primary_key=True, index=True),
+    db.Column('page_id', db.Integer, db.ForeignKey('page.id'),
+              primary_key=True, index=True))
 
 
 class User(db.Model):
@@ -226,7 +653,7 @@ class User(db.Model):
         return self.id
 
     def __eq__(self, other):
-        if isinstance(other, User):
+        if isinstance(other, (User, CachedUser)):
             return self.get_id() == other.get_id()
         return False
 
@@ -260,24 +687,131 @@ class Page(db.Model):
     def content(self):
         return self._content
 
-    @staticmethod
-    def summarize(value):
-        stripped = re.sub(r'</?[^>]+/?>', '', value)
-        cleaned = re.sub(r'[^a-zA-Z01-9,.?!]', ' ', stripped)
-        normalized = re.sub(r'\s*([.,?!])\s*', r'\1 ', cleaned)
-        condensed = re.sub(r'\s+', ' ', normalized)
-        truncated = condensed
-        if len(truncated) > 100:
-            truncated = condensed[:100] + '...'
-        return truncated
+    SUMMARY_LENGTH = 100
+    SUMMARY_TOKEN = re.compile(
+        r'([a-zA-Z0-9]+)|([,.?!])|<|[^a-zA-Z0-9,.?!<]+')
+
+    @classmethod
+    def summarize(cls, value):
+        # A single pass that gives the same result as removing tags,
+        # replacing other characters with spaces, putting one space after
+        # each punctuation mark and none before it, and condensing spaces.
+        # It stops as soon as the summary is known to be truncated.
+        parts = []
+        size = 0
+        space = False
+        after_space = False
+        has_close = True
+        pos = 0
+        end = len(value)
+        while pos < end and size <= cls.SUMMARY_LENGTH:
+            if value[pos] == '<' and has_close and pos + 1 < end and \
+                    value[pos + 1] != '>':
+                close = value.find('>', pos + 2)
+                if close >= 0:
+                    pos = close + 1
+                    continue
+                has_close = False
+            match = cls.SUMMARY_TOKEN.match(value, pos)
+            pos = match.end()
+            word, mark = match.groups()
+            if word:
+                if space:
+                    parts.append(' ')
+                    size += 1
+                    space = False
+                parts.append(word)
+                size += len(word)
+                after_space = False
+            elif mark:
+                parts.append(mark + ' ')
+                size += 2
+                space = False
+                after_space = True
+            elif not after_space:
+                space = True
+        if space:
+            parts.append(' ')
+        summary = ''.join(parts)
+        if len(summary) > cls.SUMMARY_LENGTH:
+            summary = summary[:cls.SUMMARY_LENGTH] + '...'
+        return summary
 
     @content.setter
     def content(self, value):
         if value is None:
             value = ''
         value = str(value)
+        if value == self._content and self.summary is not None:
+            return
         self._content = value
         self.summary = self.summarize(value)
+        if self.id is not None:
+            render_cache.invalidate_page(self.id)
+
+    @staticmethod
+    def hash_source(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def render_field(self, field):
+        source = getattr(self, field) or ''
+        if self.id is None:
+            return render_gfm(source)
+        source_hash = self.hash_source(source)
+        key = (self.id, field, source_hash)
+        html = render_cache.get(key)
+        if html is None:
+            rendered = RenderedHtml.query.get((self.id, field))
+            if rendered is not None and rendered.source_hash == source_hash:
+                html = rendered.html
+            else:
+                html = str(render_gfm(source))
+            render_cache.put(key, html)
+        return Markup(html)
+
+    @property
+    def rendered_content(self):
+        return self.render_field('content')
+
+    @property
+    def rendered_notes(self):
+        return self.render_field('notes')
+
+    def store_rendered_html(self, existing=None):
+        if existing is None:
+            existing = {r.field: r for r in
+                        RenderedHtml.query.filter_by(page_id=self.id)}
+        for field in RenderedHtml.FIELDS:
+            source = getattr(self, field) or ''
+            source_hash = self.hash_source(source)
+            rendered = existing.get(field)
+            if rendered is not None and rendered.source_hash == source_hash:
+                continue
+            html = str(self.render_field(field))
+            if rendered is None:
+                rendered = RenderedHtml(self.id, field)
+            rendered.source_hash = source_hash
+            rendered.html = html
+            db.session.add(rendered)
+
+    def store_links(self, existing=None):
+        # returns the slugs of every page whose backlinks show this one,
+        # before or after the change
+        if existing is None:
+            existing = {link.target_slug: link for link in
+                        PageLink.query.filter_by(source_id=self.id)}
+        targets = PageLink.parse_target_slugs(self.render_field('content'))
+        targets.discard(self.slug)
+        for slug in set(existing).difference(targets):
+            db.session.delete(existing[slug])
+        for slug in targets.difference(existing):
+            db.session.add(PageLink(self.id, slug))
+        return targets.union(existing)
+
+    @classmethod
+    def listing_columns(cls):
+        return load_only(cls.id, cls.slug, cls._title, cls.is_private,
+                         cls.date, cls.summary)
 
     @classmethod
     def get_by_slug(cls, slug):
@@ -289,12 +823,37 @@ class Page(db.Model):
 
     @classmethod
     def get_unique_slug(cls, title):
+        return cls.allocate_slug(
+            title, cls.get_taken_slugs([slugify(title)]))
+
+    SLUG_QUERY_BATCH = 100
+
+    @classmethod
+    def get_taken_slugs(cls, bases):
+        # fetch each base slug and every "base-..." slug in one range scan
+        # over the slug index, instead of probing each suffix in turn
+        bases = set(bases)
+        if not all(bases):
+            return set(slug for slug, in db.session.query(Page.slug))
+        taken = set()
+        # sqlite limits the depth of an expression, so look up a bounded
+        # number of bases per query
+        for chunk in chunked(sorted(bases), cls.SLUG_QUERY_BATCH):
+            taken.update(slug for slug, in db.session.query(Page.slug).filter(
+                db.or_(*(db.or_(Page.slug == base,
+                                db.and_(Page.slug >= base + '-',
+                                        Page.slug < base + '.'))
+                         for base in chunk))))
+        return taken
+
+    @staticmethod
+    def allocate_slug(title, taken):
         slug = slugify(title)
-        if Page.query.filter_by(slug=slug).count() > 0:
-            i = 1
-            while Page.query.filter_by(slug=slug).count() > 0:
-                slug = slugify('{} {}'.format(title, i))
-                i += 1
+        i = 1
+        while slug in taken:
+            slug = slugify('{} {}'.format(title, i))
+            i += 1
+        taken.add(slug)
         return slug
 
     @property
@@ -310,11 +869,147 @@ class Page(db.Model):
 
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False, index=True,
+                     unique=True)
 
     def __init__(self, name):
         self.name = name
 
+    @staticmethod
+    def parse_names(tags):
+        return set(
+            name for name in (
+                name.strip() for name in tags.split(',') if name)
+            if name)
+
+    @classmethod
+    def resolve(cls, names):
+        names = set(names)
+        if not names:
+            return set()
+        tags = {tag.name: tag for tag in
+                Tag.query.filter(Tag.name.in_(names))}
+        missing = names.difference(tags)
+        if missing:
+            db.session.execute(Tag.__table__.insert(),
+                               [{'name': name} for name in sorted(missing)])
+            tags.update((tag.name, tag) for tag in
+                        Tag.query.filter(Tag.name.in_(missing)))
+        return set(tags.values())
+
+    @staticmethod
+    def query_with_page_counts(include_private=False):
+        page_count = db.func.count(tags_table.c.page_id).label('page_count')
+        query = db.session.query(Tag, page_count).join(
+            tags_table, tags_table.c.tag_id == Tag.id)
+        if not include_private:
+            query = query.join(Page, Page.id == tags_table.c.page_id)
+            query = query.filter(Page.is_private.is_(False))
+        return query.group_by(Tag.id).order_by(Tag.name, Tag.id)
+
+
+class RenderedHtml(db.Model):
+    __tablename__ = 'rendered_html'
+    FIELDS = ('content', 'notes')
+
+    page_id = db.Column(db.Integer, db.ForeignKey('page.id'),
+                        primary_key=True)
+    field = db.Column(db.String(20), primary_key=True)
+    source_hash = db.Column(db.String(64), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+
+    def __init__(self, page_id, field):
+        self.page_id = page_id
+        self.field = field
+
+
+class LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.hrefs.append(href)
+
+
+class PageLink(db.Model):
+    # links are kept by target slug rather than page id, so that a link to
+    # a page that does not exist, or has been renamed, is still recorded and
+    # shows up as broken
+    __tablename__ = 'page_link'
+
+    source_id = db.Column(db.Integer, db.ForeignKey('page.id'),
+                          primary_key=True)
+    target_slug = db.Column(db.String(100), primary_key=True, index=True)
+
+    def __init__(self, source_id, target_slug):
+        self.source_id = source_id
+        self.target_slug = target_slug
+
+    @staticmethod
+    def parse_target_slugs(html):
+        parser = LinkParser()
+        parser.feed(html)
+        parser.close()
+        prefix = Config.PATH_PREFIX.rstrip('/') + '/page/'
+        slugs = set()
+        for href in parser.hrefs:
+            url = urlsplit(href)
+            if url.scheme or url.netloc or not url.path.startswith(prefix):
+                continue
+            slug = unquote(url.path[len(prefix):]).rstrip('/')
+            if slug and '/' not in slug and len(slug) <= 100:
+                slugs.add(slug)
+        return slugs
+
+    @classmethod
+    def query_backlinks(cls, page, include_private):
+        query = Page.query.options(load_only(
+            Page.id, Page.slug, Page._title, Page.is_private,
+            Page.last_updated_date)).join(
+            cls, cls.source_id == Page.id).filter(
+            cls.target_slug == page.slug, Page.id != page.id)
+        if not include_private:
+            query = query.filter(Page.is_private.is_(False))
+        return query.order_by(Page._title, Page.id)
+
+    @classmethod
+    def query_broken(cls):
+        target = db.aliased(Page)
+        return db.session.query(Page, cls.target_slug).options(load_only(
+            Page.id, Page.slug, Page._title, Page.is_private)).join(
+            cls, cls.source_id == Page.id).outerjoin(
+            target, target.slug == cls.target_slug).filter(
+            target.id.is_(None)).order_by(cls.target_slug, Page._title,
+                                          Page.id)
+
+    @classmethod
+    def query_orphans(cls, include_private):
+        # pages that no other page links to, apart from the main page
+        query = Page.query.options(Page.listing_columns()).outerjoin(
+            cls, db.and_(cls.target_slug == Page.slug,
+                         cls.source_id != Page.id)).filter(
+            cls.source_id.is_(None))
+        main_page = Options.get_main_page()
+        if main_page:
+            query = query.filter(Page._title != main_page,
+                                 Page.slug != main_page)
+        if not include_private:
+            query = query.filter(Page.is_private.is_(False))
+        return query
+
+
+class SearchTerm(db.Model):
+    __tablename__ = 'search_term'
+
+    term = db.Column(db.String(100), primary_key=True)
+    page_id = db.Column(db.Integer, db.ForeignKey('page.id'),
+                        primary_key=True, index=True)
+    weight = db.Column(db.Integer, nullable=False)
+
 
 class Option(db.Model):
     name = db.Column(db.String(100), primary_key=True)
@@ -325,13 +1020,85 @@ class Option(db.Model):
         self.value = value
 
 
+class Job(db.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    page_id = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, nullable=False)
+    updated_date = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, kind, page_id=None):
+        self.kind = kind
+        self.page_id = page_id
+        self.status = Job.PENDING
+        self.attempts = 0
+        self.created_date = datetime.now()
+        self.updated_date = self.created_date
+
+
+class OptionsCache(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load():
+        return {option.name: option.value for option in Option.query}
+
+    def get_values(self):
+        if self.ttl <= 0:
+            return self._get_request_values()
+        now = time.monotonic()
+        with self._lock:
+            if (self._values is not None and
+                    now - self._loaded_at < self.ttl):
+                self.hits += 1
+                return self._values
+            self.misses += 1
+        values = self.load()
+        with self._lock:
+            self._values = values
+            self._loaded_at = now
+        return values
+
+    def _get_request_values(self):
+        if not has_request_context():
+            self.misses += 1
+            return self.load()
+        values = getattr(g, 'stuart_options', None)
+        if values is not None:
+            self.hits += 1
+            return values
+        self.misses += 1
+        g.stuart_options = values = self.load()
+        return values
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+            self._loaded_at = None
+        if has_request_context():
+            g.pop('stuart_options', None)
+
+
+options_cache = OptionsCache(Config.OPTIONS_CACHE_TTL)
+
+
 class Options(object):
     @staticmethod
     def get(key, default_value=None):
-        option = Option.query.get(key)
-        if option is None:
-            return default_value
-        return option.value
+        return options_cache.get_values().get(key, default_value)
 
     @staticmethod
     def get_sitename():
@@ -343,7 +1110,7 @@ class Options(object):
 
     @staticmethod
     def get_revision():
-        return __revision__
+        return get_revision()
 
     @staticmethod
     def get_version():
@@ -371,9 +1138,1026 @@ class Options(object):
         return Options.get('main_page')
 
 
+class RenderCache(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key, html):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_page(self, page_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == page_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+render_cache = RenderCache(Config.RENDER_CACHE_SIZE)
+
+
+class KeysetPager(object):
+    ORDERS = {
+        'title': (Page._title, False),
+        'date': (Page.date, True),
+    }
+    DEFAULT_PER_PAGE = 20
+    MAX_PER_PAGE = 100
+
+    def __init__(self, query, order='title', after=None, before=None,
+                 per_page=None, count=False):
+        if order not in self.ORDERS:
+            raise BadRequest('Unknown order "{}".'.format(order))
+        if per_page is None:
+            per_page = self.DEFAULT_PER_PAGE
+        per_page = max(1, min(per_page, self.MAX_PER_PAGE))
+        self.order = order
+        self.per_page = per_page
+        self.total = query.order_by(None).count() if count else None
+
+        column, descending = self.ORDERS[order]
+        backwards = before is not None
+        cursor = before if backwards else after
+        if cursor is not None:
+            value, page_id = self.decode_cursor(order, cursor)
+            query = query.filter(self._seek(column, value, page_id,
+                                            descending != backwards))
+        if descending != backwards:
+            query = query.order_by(column.desc(), Page.id.desc())
+        else:
+            query = query.order_by(column.asc(), Page.id.asc())
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev = has_more
+            self.has_next = True
+        else:
+            self.has_prev = cursor is not None
+            self.has_next = has_more
+        self.items = items
+
+    @staticmethod
+    def _seek(column, value, page_id, descending):
+        if descending:
+            return db.or_(column < value,
+                          db.and_(column == value, Page.id < page_id))
+        return db.or_(column > value,
+                      db.and_(column == value, Page.id > page_id))
+
+    @classmethod
+    def encode_cursor(cls, order, page):
+        value = getattr(page, cls.ORDERS[order][0].key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data = json.dumps([value, page.id]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, order, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            value, page_id = json.loads(base64.urlsafe_b64decode(padded))
+            if order == 'date':
+                value = datetime.fromisoformat(value)
+            return value, int(page_id)
+        except (ValueError, TypeError):
+            raise BadRequest('Invalid page cursor.')
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return self.encode_cursor(self.order, self.items[0])
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return self.encode_cursor(self.order, self.items[-1])
+
+    ARGS = ('order', 'after', 'before', 'per_page')
+
+    @classmethod
+    def from_request(cls, query):
+        return cls(query,
+                   order=request.args.get('order', 'title'),
+                   after=request.args.get('after'),
+                   before=request.args.get('before'),
+                   per_page=request.args.get('per_page', type=int),
+                   count=Config.COUNT_PAGES)
+
+
+class SearchIndex(object):
+    TITLE_WEIGHT = 10
+    TAGS_WEIGHT = 5
+    TABLE = None
+
+    def create(self):
+        pass
+
+    def drop(self):
+        pass
+
+    def index_pages(self, pages):
+        raise NotImplementedError
+
+    def search_ids(self, text, include_private, limit):
+        raise NotImplementedError
+
+    @staticmethod
+    def tokenize(text):
+        return [term[:100] for term in re.findall(r'\w+', text.lower())]
+
+    @staticmethod
+    def document(page):
+        return {'id': page.id,
+                'title': page.title or '',
+                'content': page.content or '',
+                'tags': ' '.join(tag.name for tag in page.tags)}
+
+    def search(self, text, include_private=False, limit=50):
+        if not self.tokenize(text):
+            return []
+        ids = self.search_ids(text, include_private, limit)
+        if not ids:
+            return []
+        pages = Page.query.options(Page.listing_columns()).filter(
+            Page.id.in_(ids))
+        pages_by_id = {page.id: page for page in pages}
+        return [pages_by_id[i] for i in ids if i in pages_by_id]
+
+
+class PythonSearchIndex(SearchIndex):
+    TABLE = 'search_term'
+
+    def index_pages(self, pages):
+        pages = list(pages)
+        if not pages:
+            return
+        SearchTerm.query.filter(
+            SearchTerm.page_id.in_([page.id for page in pages])).delete(
+            synchronize_session=False)
+        rows = []
+        for page in pages:
+            doc = self.document(page)
+            weights = {}
+            for field, weight in (('title', self.TITLE_WEIGHT),
+                                  ('tags', self.TAGS_WEIGHT),
+                                  ('content', 1)):
+                for term in self.tokenize(doc[field]):
+                    weights[term] = weights.get(term, 0) + weight
+            rows.extend({'term': term, 'page_id': page.id, 'weight': weight}
+                        for term, weight in weights.items())
+        if rows:
+            db.session.execute(SearchTerm.__table__.insert(), rows)
+
+    def drop(self):
+        SearchTerm.query.delete(synchronize_session=False)
+
+    def search_ids(self, text, include_private, limit):
+        terms = set(self.tokenize(text))
+        score = db.func.sum(SearchTerm.weight)
+        query = db.session.query(SearchTerm.page_id).filter(
+            SearchTerm.term.in_(terms))
+        if not include_private:
+            query = query.join(Page, Page.id == SearchTerm.page_id)
+            query = query.filter(Page.is_private.is_(False))
+        query = query.group_by(SearchTerm.page_id).having(
+            db.func.count(SearchTerm.term) == len(terms))
+        query = query.order_by(score.desc(), SearchTerm.page_id)
+        return [page_id for page_id, in query.limit(limit)]
+
+
+class SqliteSearchIndex(SearchIndex):
+    TABLE = 'page_fts'
+
+    def create(self):
+        db.session.execute(db.text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS page_fts '
+            'USING fts5(title, content, tags)'))
+
+    def drop(self):
+        db.session.execute(db.text('DROP TABLE IF EXISTS page_fts'))
+
+    def index_pages(self, pages):
+        docs = [self.document(page) for page in pages]
+        if not docs:
+            return
+        db.session.execute(
+            db.text('DELETE FROM page_fts WHERE rowid = :id'),
+            [{'id': doc['id']} for doc in docs])
+        db.session.execute(
+            db.text('INSERT INTO page_fts (rowid, title, content, tags) '
+                    'VALUES (:id, :title, :content, :tags)'),
+            docs)
+
+    def search_ids(self, text, include_private, limit):
+        match = ' '.join('"{}"'.format(term)
+                         for term in self.tokenize(text))
+        sql = ('SELECT page.id FROM page_fts '
+               'JOIN page ON page.id = page_fts.rowid '
+               'WHERE page_fts MATCH :match ')
+        if not include_private:
+            sql += 'AND page.is_private = 0 '
+        sql += ('ORDER BY bm25(page_fts, {}, 1.0, {}) '
+                'LIMIT :limit'.format(float(self.TITLE_WEIGHT),
+                                      float(self.TAGS_WEIGHT)))
+        result = db.session.execute(db.text(sql),
+                                    {'match': match, 'limit': limit})
+        return [page_id for page_id, in result]
+
+
+class PostgresSearchIndex(SearchIndex):
+    TABLE = 'page_search'
+
+    def create(self):
+        db.session.execute(db.text(
+            'CREATE TABLE IF NOT EXISTS page_search ('
+            'page_id INTEGER PRIMARY KEY REFERENCES page (id), '
+            'document TSVECTOR NOT NULL)'))
+        db.session.execute(db.text(
+            'CREATE INDEX IF NOT EXISTS ix_page_search_document '
+            'ON page_search USING GIN (document)'))
+
+    def drop(self):
+        db.session.execute(db.text('DROP TABLE IF EXISTS page_search'))
+
+    def index_pages(self, pages):
+        docs = [self.document(page) for page in pages]
+        if not docs:
+            return
+        db.session.execute(
+            db.text("INSERT INTO page_search (page_id, document) VALUES ("
+                    ":id, "
+                    "setweight(to_tsvector('english', :title), 'A') || "
+                    "setweight(to_tsvector('english', :tags), 'B') || "
+                    "setweight(to_tsvector('english', :content), 'D')) "
+                    "ON CONFLICT (page_id) "
+                    "DO UPDATE SET document = EXCLUDED.document"),
+            docs)
+
+    def search_ids(self, text, include_private, limit):
+        sql = ("SELECT page.id FROM page_search "
+               "JOIN page ON page.id = page_search.page_id, "
+               "plainto_tsquery('english', :text) AS query "
+               "WHERE page_search.document @@ query ")
+        if not include_private:
+            sql += 'AND NOT page.is_private '
+        sql += ('ORDER BY ts_rank(page_search.document, query) DESC, '
+                'page.id LIMIT :limit')
+        result = db.session.execute(db.text(sql),
+                                    {'text': text, 'limit': limit})
+        return [page_id for page_id, in result]
+
+
+search_index_classes = {
+    'python': PythonSearchIndex,
+    'sqlite': SqliteSearchIndex,
+    'postgresql': PostgresSearchIndex,
+}
+
+
+def get_search_index():
+    backend = Config.SEARCH_BACKEND
+    if backend == 'auto':
+        backend = db.engine.dialect.name
+    if backend not in search_index_classes:
+        backend = 'python'
+    return search_index_classes[backend]()
+
+
+class ResponseCache(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, query):
+        entry = self._get(path, query)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _get(self, path, query):
+        raise NotImplementedError
+
+    def set(self, path, query, entry):
+        raise NotImplementedError
+
+    def invalidate(self, path):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    # each process has its own copy, which only that process invalidates,
+    # so entries also expire after ttl seconds to bound how long another
+    # process, or a command, can leave a stale response in it
+    def __init__(self, max_bytes, ttl=0):
+        super(MemoryResponseCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._queries_by_path = {}
+        self._lock = threading.Lock()
+
+    def _get(self, path, query):
+        key = (path, query)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, stored_at = item
+            if self.ttl > 0 and time.monotonic() - stored_at >= self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, path, query, entry):
+        body_size = len(entry[2])
+        if body_size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove((path, query))
+            self._entries[(path, query)] = (entry, time.monotonic())
+            self._queries_by_path.setdefault(path, set()).add(query)
+            self.size += body_size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        self.size -= len(item[0][2])
+        queries = self._queries_by_path[key[0]]
+        queries.discard(key[1])
+        if not queries:
+            del self._queries_by_path[key[0]]
+
+    def invalidate(self, path):
+        with self._lock:
+            for query in list(self._queries_by_path.get(path, ())):
+                self._remove((path, query))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._queries_by_path.clear()
+            self.size = 0
+
+
+class FilesystemResponseCache(ResponseCache):
+    # the directory is shared by all processes, so instead of keeping
+    # count of its size, each process now and then sweeps it, removing the
+    # entries older than ttl and then, oldest first, those beyond max_bytes
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, directory, max_bytes=0, ttl=0):
+        super(FilesystemResponseCache, self).__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._swept_at = time.monotonic()
+        self._written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def _path_dir(self, path):
+        return os.path.join(self.directory, self._hash(path))
+
+    def _filename(self, path, query):
+        return os.path.join(self._path_dir(path), self._hash(query))
+
+    def _get(self, path, query):
+        try:
+            with open(self._filename(path, query), 'rb') as f:
+                if self.ttl > 0 and \
+                        time.time() - os.fstat(f.fileno()).st_mtime >= \
+                        self.ttl:
+                    return None
+                status, headers = json.loads(f.readline())
+                return status, headers, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def set(self, path, query, entry):
+        status, headers, body = entry
+        data = json.dumps([status, headers]).encode('utf-8') + b'\n' + body
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+        os.makedirs(self._path_dir(path), exist_ok=True)
+        atomic_write(self._filename(path, query), data)
+        now = time.monotonic()
+        with self._lock:
+            self._written += len(data)
+            due = (now - self._swept_at >= self.SWEEP_INTERVAL or
+                   (self.max_bytes and self._written >= self.max_bytes // 4))
+            if due:
+                self._swept_at = now
+                self._written = 0
+        if due:
+            self.sweep()
+
+    def sweep(self):
+        files = []
+        for path_dir in os.scandir(self.directory):
+            if not path_dir.is_dir():
+                continue
+            for entry in os.scandir(path_dir.path):
+                # leave the temporary files of writes in progress alone
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        now = time.time()
+        removed = 0
+        for mtime, size, filename in files:
+            expired = self.ttl > 0 and now - mtime >= self.ttl
+            if not expired and (not self.max_bytes or
+                                total <= self.max_bytes):
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def invalidate(self, path):
+        shutil.rmtree(self._path_dir(path), ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+
+
+def create_response_cache():
+    if Config.RESPONSE_CACHE == 'memory':
+        return MemoryResponseCache(Config.RESPONSE_CACHE_MAX_BYTES,
+                                   Config.RESPONSE_CACHE_TTL)
+    if Config.RESPONSE_CACHE == 'filesystem':
+        if not Config.RESPONSE_CACHE_DIR:
+            raise ConfigError('The filesystem response cache requires a '
+                              'response cache directory.')
+        return FilesystemResponseCache(Config.RESPONSE_CACHE_DIR,
+                                       Config.RESPONSE_CACHE_MAX_BYTES,
+                                       Config.RESPONSE_CACHE_TTL)
+    return None
+
+
+response_cache = create_response_cache()
+
+
+def cache_anonymous(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if response_cache is None or current_user.is_authenticated:
+            return view(*args, **kwargs)
+        if any(name not in KeysetPager.ARGS for name in request.args):
+            # no view reads any other argument, so caching them would only
+            # let clients fill the cache with copies of the same response
+            return view(*args, **kwargs)
+        path = request.path
+        query = urlencode(sorted(request.args.items(multi=True)))
+        entry = response_cache.get(path, query)
+        if entry is not None:
+            status, headers, body = entry
+            response = Response(body, status=status, headers=headers)
+            return response.make_conditional(request)
+        response = make_response(view(*args, **kwargs))
+        cacheable = (response.status_code == 200 and
+                     'Set-Cookie' not in response.headers)
+        if cacheable:
+            response_cache.set(path, query, (
+                response.status_code, list(response.headers.items()),
+                response.get_data()))
+        return response
+    return wrapper
+
+
+def invalidate_responses(paths):
+    if response_cache is None:
+        return
+    for path in paths:
+        response_cache.invalidate(path)
+
+
+def page_response_paths(page):
+    return {'/page/{}'.format(page.slug)}
+
+
+def tag_response_paths(tags):
+    return {'/tags/{}'.format(tag.id) for tag in tags}
+
+
+def main_page_response_paths(*names):
+    main_page = Options.get_main_page()
+    if main_page and main_page in names:
+        return {'/'}
+    return set()
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self.copy(value)
+                    for key, value in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def copy(value):
+        return value
+
+    def render(self, values):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+        for key in sorted(values):
+            for line in self.render_sample(key, values[key]):
+                yield line
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # for counters kept elsewhere, such as the hit counts of the caches
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render_sample(self, key, value):
+        yield '{}{} {}'.format(self.name,
+                               format_labels(self.labelnames, key),
+                               format_value(value))
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                       10)
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # one count per bucket, then the +Inf bucket, then the sum
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    @staticmethod
+    def copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render_sample(self, key, values):
+        count = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), values):
+            count += bucket
+            yield '{}_bucket{} {}'.format(
+                self.name,
+                format_labels(self.labelnames, key,
+                              [('le', format_value(bound))]),
+                format_value(count))
+        labels = format_labels(self.labelnames, key)
+        yield '{}_sum{} {}'.format(self.name, labels, format_value(values[-1]))
+        yield '{}_count{} {}'.format(self.name, labels, format_value(count))
+
+
+class HitRatio(object):
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, hits, misses):
+        self.name = name
+        self.documentation = documentation
+        self.hits = hits
+        self.misses = misses
+
+    def render(self, merged):
+        hits = merged.get(self.hits.name, {})
+        misses = merged.get(self.misses.name, {})
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+        for key in sorted(set(hits) | set(misses)):
+            total = hits.get(key, 0) + misses.get(key, 0)
+            if total:
+                yield '{}{} {}'.format(
+                    self.name, format_labels(self.hits.labelnames, key),
+                    format_value(hits.get(key, 0) / total))
+
+
+class MetricsRegistry(object):
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.process_id = os.getpid()
+        self.metrics = OrderedDict()
+        self.derived = []
+        self.collectors = []
+        self._flushed_at = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, documentation, labelnames=()):
+        self.metrics[name] = Counter(name, documentation, labelnames)
+        return self.metrics[name]
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        self.metrics[name] = Histogram(name, documentation, labelnames,
+                                       **kwargs)
+        return self.metrics[name]
+
+    def hit_ratio(self, name, documentation, hits, misses):
+        self.derived.append(HitRatio(name, documentation, hits, misses))
+
+    def reset(self):
+        # a forked worker starts from zero rather than from its parent's
+        # counts, which the parent reports itself
+        self.process_id = os.getpid()
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        return {name: metric.snapshot()
+                for name, metric in self.metrics.items()}
+
+    def _filename(self, process_id):
+        return os.path.join(self.directory,
+                            'metrics-{}.json'.format(process_id))
+
+    def flush(self):
+        if not self.directory:
+            return
+        data = {name: [[list(key), value] for key, value in values.items()]
+                for name, values in self.snapshot().items()}
+        atomic_write(self._filename(self.process_id),
+                     json.dumps(data).encode('utf-8'))
+        self._flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if (self.directory and
+                time.monotonic() - self._flushed_at >= self.FLUSH_INTERVAL):
+            self.flush()
+
+    def collect(self):
+        merged = self.snapshot()
+        if not self.directory:
+            return merged
+        own = os.path.basename(self._filename(self.process_id))
+        for filename in os.listdir(self.directory):
+            if (filename == own or not filename.startswith('metrics-') or
+                    not filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, samples in data.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                values = merged[name]
+                for key, value in samples:
+                    key = tuple(key)
+                    if key in values:
+                        values[key] = metric.merge(values[key], value)
+                    else:
+                        values[key] = value
+        return merged
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render(merged[name]))
+        for metric in self.derived:
+            lines.extend(metric.render(merged))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(Config.METRICS_DIR if Config.METRICS else None)
+os.register_at_fork(after_in_child=metrics.reset)
+if metrics.directory:
+    atexit.register(metrics.flush)
+
+http_requests_total = metrics.counter(
+    'stuart_http_requests_total', 'The number of requests handled.',
+    ['endpoint', 'method', 'status'])
+http_request_seconds = metrics.histogram(
+    'stuart_http_request_duration_seconds',
+    'The time taken to handle requests.', ['endpoint'])
+db_query_seconds = metrics.histogram(
+    'stuart_db_query_duration_seconds',
+    'The time taken to execute database queries.',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1))
+markdown_seconds = metrics.histogram(
+    'stuart_markdown_render_duration_seconds',
+    'The time taken to render markdown to HTML.')
+login_seconds = metrics.histogram(
+    'stuart_login_duration_seconds',
+    'The time taken to handle login attempts.', ['result'])
+bcrypt_seconds = metrics.histogram(
+    'stuart_bcrypt_duration_seconds',
+    'The time taken to hash and check passwords.', ['operation'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+cache_hits_total = metrics.counter(
+    'stuart_cache_hits_total', 'The number of cache lookups that hit.',
+    ['cache'])
+cache_misses_total = metrics.counter(
+    'stuart_cache_misses_total', 'The number of cache lookups that missed.',
+    ['cache'])
+metrics.hit_ratio('stuart_cache_hit_ratio',
+                  'The fraction of cache lookups that hit.',
+                  cache_hits_total, cache_misses_total)
+
+
+def collect_cache_metrics():
+    caches = {'render': render_cache, 'options': options_cache,
+              'response': response_cache, 'user': user_cache}
+    for name, cache in caches.items():
+        if cache is not None:
+            cache_hits_total.set(cache.hits, cache=name)
+            cache_misses_total.set(cache.misses, cache=name)
+
+
+metrics.collectors.append(collect_cache_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        http_request_seconds.observe(time.perf_counter() - start,
+                                     endpoint=endpoint)
+        http_requests_total.inc(endpoint=endpoint, method=request.method,
+                                status=response.status_code)
+    metrics.maybe_flush()
+    return response
+
+
+class RequestTimings(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0
+        self.markdown_time = 0
+        self.template_time = 0
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        return ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(
+                self.db_time * 1000, self.queries),
+            'md;dur={:.1f}'.format(self.markdown_time * 1000),
+            'tpl;dur={:.1f}'.format(self.template_time * 1000),
+            'total;dur={:.1f}'.format(self.total_time * 1000),
+        ])
+
+
+def get_request_timings():
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not Config.SQLITE_WAL or \
+            not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA mmap_size={:d}'.format(Config.SQLITE_MMAP_SIZE))
+    cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    if not conn.info.get('query_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    db_query_seconds.observe(elapsed)
+    timings = get_request_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.db_time += elapsed
+
+
+@app.before_request
+def start_request_timings():
+    if Config.INSTRUMENT:
+        g.timings = RequestTimings()
+
+
+@app.after_request
+def report_request_timings(response):
+    timings = get_request_timings()
+    if timings is None:
+        return response
+    response.headers['Server-Timing'] = timings.server_timing()
+    total_ms = timings.total_time * 1000
+    if total_ms >= Config.SLOW_REQUEST_MS:
+        app.logger.warning(
+            'Slow request: %s %s took %.1fms (%d queries in %.1fms, '
+            'markdown %.1fms, templates %.1fms)', request.method,
+            request.full_path.rstrip('?'), total_ms, timings.queries,
+            timings.db_time * 1000, timings.markdown_time * 1000,
+            timings.template_time * 1000)
+    return response
+
+
+def render_template(template_name, **context):
+    timings = get_request_timings()
+    if timings is None:
+        return flask_render_template(template_name, **context)
+    start = time.perf_counter()
+    nested = timings.db_time + timings.markdown_time
+    try:
+        return flask_render_template(template_name, **context)
+    finally:
+        # lazy loads and markdown filters run inside the template; count
+        # them under their own headings rather than twice
+        nested = timings.db_time + timings.markdown_time - nested
+        timings.template_time += time.perf_counter() - start - nested
+
+
+class CachedUser(object):
+    # the parts of a user that requests read, detached from any session
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self):
+        return self.id
+
+    def __eq__(self, other):
+        if isinstance(other, (User, CachedUser)):
+            return self.get_id() == other.get_id()
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class UserCache(object):
+    MAX_ENTRIES = 1024
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        key = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        user = User.query.get(user_id)
+        if user is not None:
+            user = CachedUser(user)
+        if self.ttl > 0:
+            with self._lock:
+                if len(self._entries) >= self.MAX_ENTRIES:
+                    self._entries.clear()
+                self._entries[key] = (user, now)
+        return user
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+
+
+user_cache = UserCache(Config.USER_CACHE_TTL)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return user_cache.get(user_id)
 
 
 @app.context_processor
@@ -381,16 +2165,41 @@ def setup_options():
     return {'Options': Options}
 
 
+class MarkdownRenderer(threading.local):
+    # building a Markdown instance sets up every processor of every
+    # extension, so each thread keeps one and resets it after each use
+    def __init__(self):
+        self.converter = None
+
+    def render(self, source):
+        if self.converter is None:
+            from mdx_gfm import GithubFlavoredMarkdownExtension
+            self.converter = markdown.Markdown(
+                extensions=[GithubFlavoredMarkdownExtension()])
+        try:
+            return self.converter.convert(source)
+        finally:
+            self.converter.reset()
+
+
+markdown_renderer = MarkdownRenderer()
+
+
 @app.template_filter(name='gfm')
 def render_gfm(s):
-    from mdx_gfm import GithubFlavoredMarkdownExtension
-    output = markdown.markdown(
-        s, extensions=[GithubFlavoredMarkdownExtension()])
+    timings = get_request_timings()
+    start = time.perf_counter()
+    output = markdown_renderer.render(s)
+    elapsed = time.perf_counter() - start
+    markdown_seconds.observe(elapsed)
+    if timings is not None:
+        timings.markdown_time += elapsed
     moutput = Markup(output)
     return moutput
 
 
 @app.route("/")
+@cache_anonymous
 def index():
     page_name = Options.get_main_page()
     page = Page.get_by_title(page_name)
@@ -403,15 +2212,80 @@ def index():
 
 
 @app.route('/all-pages')
+@cache_anonymous
 def all_pages():
-    query = Page.query
+    query = Page.query.options(Page.listing_columns())
     if not current_user.is_authenticated:
         query = query.filter_by(is_private=False)
-    query = query.order_by(Page._title.asc())
-    pager = query.paginate()
-    pages = query
-    return render_template("all_pages.html", pages=pages, pager=pager,
-                           page_links_endpoint='all_pages')
+    pager = KeysetPager.from_request(query)
+    return render_template("all_pages.html", pager=pager,
+                           page_links_endpoint='all_pages',
+                           page_links_args={})
+
+
+@app.route('/search')
+def search():
+    text = request.args.get('q', '').strip()
+    pages = get_search_index().search(
+        text, include_private=current_user.is_authenticated)
+    return render_template('search.html', text=text, pages=pages)
+
+
+class RateLimiter(object):
+    MAX_KEYS = 10000
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def attempt(self, key):
+        # returns 0 if the attempt is allowed, otherwise the number of
+        # seconds until it would be
+        if self.limit <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            attempts = [t for t in self._attempts.get(key, ())
+                        if now - t < self.window]
+            if len(attempts) >= self.limit:
+                self._attempts[key] = attempts
+                return max(1, math.ceil(attempts[0] + self.window - now))
+            if key not in self._attempts and \
+                    len(self._attempts) >= self.MAX_KEYS:
+                self._prune(now)
+            attempts.append(now)
+            self._attempts[key] = attempts
+            return 0
+
+    def _prune(self, now):
+        for key in [key for key, attempts in self._attempts.items()
+                    if now - attempts[-1] >= self.window]:
+            del self._attempts[key]
+        if len(self._attempts) >= self.MAX_KEYS:
+            self._attempts.clear()
+
+
+login_limiter = RateLimiter(Config.LOGIN_RATE_LIMIT, Config.LOGIN_RATE_WINDOW)
+login_slots = None
+if Config.LOGIN_CONCURRENCY > 0:
+    login_slots = threading.BoundedSemaphore(Config.LOGIN_CONCURRENCY)
+
+
+def check_login_password(user, password):
+    if login_slots is not None and not login_slots.acquire(blocking=False):
+        raise ServiceUnavailable(retry_after=1)
+    try:
+        if not check_password(user.hashed_password, password):
+            return False
+        if get_hash_rounds(user.hashed_password) != Config.BCRYPT_ROUNDS:
+            user.hashed_password = hash_password(password)
+            db.session.commit()
+        return True
+    finally:
+        if login_slots is not None:
+            login_slots.release()
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -419,32 +2293,92 @@ def login():
     if request.method == 'GET':
         return render_template('login.html')
 
+    retry_after = login_limiter.attempt(request.remote_addr)
+    if retry_after:
+        raise TooManyRequests(retry_after=retry_after)
+
+    start = time.perf_counter()
     email = request.form['email']
     password = request.form['password']
     user = User.query.filter_by(email=email).first()
     if user is None:
+        login_seconds.observe(time.perf_counter() - start, result='failure')
         flash('Password is invalid', 'error')
         raise BadRequest
-    if not bcrypt.check_password_hash(user.hashed_password, password):
+    if not check_login_password(user, password):
+        login_seconds.observe(time.perf_counter() - start, result='failure')
         flash('Password is invalid', 'error')
         return redirect(url_for('login'))
 
     login_user(user)
+    login_seconds.observe(time.perf_counter() - start, result='success')
     flash('Logged in successfully')
     # return redirect(request.args.get('next_url') or url_for('index'))
     return redirect(url_for('index'))
 
 
 @app.route('/page/<slug>', methods=['GET'])
+@cache_anonymous
 def get_page(slug):
-    page = Page.get_by_slug(slug)
+    page = Page.query.options(load_only(
+        Page.id, Page.slug, Page.is_private, Page.date,
+        Page.last_updated_date)).filter(Page.slug == slug).first()
     if not page:
         raise NotFound()
     if page.is_private and not current_user.is_authenticated:
         raise Unauthorized()
     user = current_user
-
-    return render_template('page.html', config=Config, page=page, user=user)
+    backlinks = PageLink.query_backlinks(
+        page, include_private=current_user.is_authenticated).all()
+
+    etag = get_page_etag(page, backlinks)
+    last_modified = max([page.last_updated_date] +
+                        [p.last_updated_date for p in backlinks])
+    last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        # only the columns above are needed for a 304; load the rest in one
+        # query instead of one for each column the template touches
+        db.session.refresh(page)
+        response = make_response(render_template(
+            'page.html', config=Config, page=page, user=user,
+            backlinks=backlinks))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.vary.add('Cookie')
+    if page.is_private or current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = Config.PAGE_MAX_AGE
+    return response
+
+
+def get_page_etag(page, backlinks=()):
+    user_id = ''
+    if current_user.is_authenticated:
+        user_id = current_user.get_id()
+    # the backlinks change when other pages are edited, and the date and
+    # the site options shown on the page can be changed from the command
+    # line, without changing the page's last updated date
+    backlinks_key = ','.join('{}@{}'.format(
+        p.id, p.last_updated_date.isoformat()) for p in backlinks)
+    options_key = json.dumps(sorted(options_cache.get_values().items()))
+    key = '{}:{}:{}:{}:{}:{}:{}'.format(
+        page.id, page.date.isoformat(), page.last_updated_date.isoformat(),
+        user_id, get_revision(), backlinks_key, options_key)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def is_not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
 
 
 @app.route('/edit/<slug>', methods=['GET', 'POST'])
@@ -467,35 +2401,38 @@ def edit_page(slug):
                            request.form['is_private']))
     tags = request.form['tags']
 
-    page.title = title
-    page.content = content
-    page.notes = notes
-    page.is_private = is_private
-    page.last_updated_date = datetime.now()
-
-    current_tags = set(page.tags)
-    next_tag_names = set(
-        name for name in (
-            name.strip() for name in tags.split(',') if name)
-        if name)
-    next_tags = set()
-    for name in next_tag_names:
-        tag = Tag.query.filter_by(name=name).first()
-        if tag is None:
-            tag = Tag(name)
-        next_tags.add(tag)
-    tags_to_add = next_tags.difference(current_tags)
-    tags_to_remove = current_tags.difference(next_tags)
-
-    for ttr in tags_to_remove:
-        page.tags.remove(ttr)
-    page.tags.extend(tags_to_add)
-
-    for tta in tags_to_add:
-        db.session.add(tta)
-    db.session.add(page)
-    db.session.commit()
-    return redirect(url_for('get_page', slug=page.slug))
+    def update(attempt):
+        old_title = page.title
+        was_private = page.is_private
+        page.title = title
+        page.content = content
+        page.notes = notes
+        page.is_private = is_private
+        page.last_updated_date = datetime.now()
+
+        current_tags = set(page.tags)
+        next_tags = Tag.resolve(Tag.parse_names(tags))
+        tags_to_add = next_tags.difference(current_tags)
+        tags_to_remove = current_tags.difference(next_tags)
+
+        for ttr in tags_to_remove:
+            page.tags.remove(ttr)
+        page.tags.extend(tags_to_add)
+
+        paths = set()
+        if response_cache is not None:
+            # collected before the commit expires the page and its tags
+            paths = page_response_paths(page) | {'/all-pages'}
+            paths |= main_page_response_paths(old_title, page.title,
+                                              page.slug)
+            paths |= tag_response_paths(current_tags | next_tags)
+            if tags_to_add or tags_to_remove or \
+                    was_private != page.is_private:
+                paths.add('/tags')
+        return paths
+
+    invalidate_responses(save_page(page, update))
+    return redirect(url_for('get_page', slug=slug))
 
 
 @app.route('/new', methods=['GET', 'POST'])
@@ -517,38 +2454,237 @@ def create_new():
 
     page = Page(title, content, datetime.now(), is_private, notes)
 
-    next_tag_names = set(
-        name for name in (
-            name.strip() for name in tags.split(',') if name)
-        if name)
-    next_tags = set()
-    for name in next_tag_names:
-        tag = Tag.query.filter_by(name=name).first()
-        if tag is None:
-            tag = Tag(name)
-        next_tags.add(tag)
-    tags_to_add = next_tags
-    page.tags.extend(tags_to_add)
+    save_new_page(page, Tag.parse_names(tags))
 
-    db.session.add(page)
-    db.session.commit()
+    if response_cache is not None:
+        paths = page_response_paths(page) | {'/all-pages'}
+        paths |= main_page_response_paths(page.title, page.slug)
+        paths |= tag_response_paths(page.tags)
+        if page.tags:
+            paths.add('/tags')
+        invalidate_responses(paths)
     return redirect(url_for('get_page', slug=page.slug))
 
 
+def save_page(page, update, attempts=3):
+    # another request may take the same slug or create the same tag
+    # between the lookup and the insert; the unique indexes catch that,
+    # so roll back, make the changes again with update(attempt), and retry
+    for attempt in range(attempts):
+        try:
+            result = update(attempt)
+            db.session.add(page)
+            db.session.flush()
+            job_ids = job_queue.enqueue_page_jobs(page)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if attempt + 1 >= attempts:
+                raise
+        else:
+            job_queue.dispatch(job_ids)
+            return result
+
+
+def save_new_page(page, tag_names=(), attempts=3):
+    def update(attempt):
+        if attempt > 0:
+            page.slug = Page.get_unique_slug(page.title)
+        page.tags = list(Tag.resolve(tag_names))
+
+    save_page(page, update, attempts)
+
+
+class JobQueue(object):
+    # work derived from a saved page is recorded in the job table in the
+    # same transaction as the page, and done after the commit by a pool of
+    # threads, so that saving does not wait for it and a restart does not
+    # lose it. Until the pool is started, as in commands and tests, jobs
+    # are run in the calling thread as soon as they are dispatched.
+    MAX_ATTEMPTS = 3
+    STALE_SECONDS = 600
+    PAGE_JOBS = ('render_page', 'index_page', 'link_page')
+
+    def __init__(self):
+        self.handlers = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def handler(self, kind):
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    @property
+    def is_started(self):
+        return self._executor is not None
+
+    def start(self, threads):
+        with self._lock:
+            if self._executor is not None or threads < 1:
+                return
+            self._executor = ThreadPoolExecutor(
+                threads, thread_name_prefix='stuart-job')
+            # pick up the jobs left behind by a previous process
+            self._executor.submit(self.run_in_context, self.run_pending)
+
+    def stop(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def enqueue(self, kind, page_id=None):
+        job = Job(kind, page_id)
+        db.session.add(job)
+        return job
+
+    def enqueue_page_jobs(self, page):
+        jobs = [self.enqueue(kind, page.id) for kind in self.PAGE_JOBS]
+        db.session.flush()
+        return [job.id for job in jobs]
+
+    def dispatch(self, job_ids):
+        # called after the commit that stored the jobs
+        with self._lock:
+            executor = self._executor
+            if executor is not None:
+                for job_id in job_ids:
+                    executor.submit(self.run_in_context, self.run, job_id)
+                return
+        for job_id in job_ids:
+            self.run(job_id)
+
+    def run_in_context(self, f, *args):
+        try:
+            with app.app_context():
+                return f(*args)
+        except Exception:
+            app.logger.exception('Background job failed')
+
+    def claim(self, job_id):
+        # the conditional update lets only one thread or process run a job
+        claimed = Job.query.filter_by(id=job_id, status=Job.PENDING).update(
+            {'status': Job.RUNNING, 'attempts': Job.attempts + 1,
+             'updated_date': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def run(self, job_id):
+        while self.claim(job_id):
+            job = Job.query.get(job_id)
+            try:
+                self.handlers[job.kind](job.page_id)
+                db.session.delete(job)
+                db.session.commit()
+                return True
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning('Job %s (%s) failed: %s', job_id,
+                                   job.kind, e)
+                job = Job.query.get(job_id)
+                job.error = '{}: {}'.format(type(e).__name__, e)
+                job.updated_date = datetime.now()
+                if job.attempts < self.MAX_ATTEMPTS:
+                    job.status = Job.PENDING
+                else:
+                    job.status = Job.FAILED
+                db.session.commit()
+        return False
+
+    def run_pending(self):
+        job_ids = [job_id for job_id, in db.session.query(Job.id).filter_by(
+            status=Job.PENDING).order_by(Job.id)]
+        return sum(1 for job_id in job_ids if self.run(job_id))
+
+    def retry(self):
+        # failed jobs, and running jobs whose process has probably died,
+        # are made pending again with a fresh set of attempts
+        stale = datetime.fromtimestamp(time.time() - self.STALE_SECONDS)
+        count = Job.query.filter(db.or_(
+            Job.status == Job.FAILED,
+            db.and_(Job.status == Job.RUNNING, Job.updated_date < stale))
+        ).update({'status': Job.PENDING, 'attempts': 0},
+                 synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+job_queue = JobQueue()
+
+
+@job_queue.handler('render_page')
+def render_page_job(page_id):
+    page = Page.query.get(page_id)
+    if page is not None:
+        page.store_rendered_html()
+        db.session.commit()
+
+
+@job_queue.handler('index_page')
+def index_page_job(page_id):
+    page = Page.query.get(page_id)
+    if page is not None:
+        get_search_index().index_pages([page])
+        db.session.commit()
+
+
+@job_queue.handler('link_page')
+def link_page_job(page_id):
+    page = Page.query.get(page_id)
+    if page is not None:
+        slugs = page.store_links()
+        db.session.commit()
+        invalidate_responses({'/page/{}'.format(slug) for slug in slugs})
+
+
 @app.route('/tags', methods=['GET'])
+@cache_anonymous
 def list_tags():
-    tags = Tag.query
+    tags = Tag.query_with_page_counts(
+        include_private=current_user.is_authenticated)
     return render_template('list_tags.html', tags=tags)
 
 
 @app.route('/tags/<tag_id>', methods=['GET'])
+@cache_anonymous
 def get_tag(tag_id):
     tag = Tag.query.get(tag_id)
-    query = tag.pages
+    if not tag:
+        raise NotFound()
+    query = tag.pages.options(Page.listing_columns())
     if not current_user.is_authenticated:
         query = query.filter_by(is_private=False)
-    pages = query
-    return render_template("tag.html", tag=tag, pages=pages)
+    pager = KeysetPager.from_request(query)
+    return render_template("tag.html", tag=tag, pager=pager,
+                           page_links_endpoint='get_tag',
+                           page_links_args={'tag_id': tag.id})
+
+
+@app.route('/broken-links', methods=['GET'])
+@login_required
+def broken_links():
+    links = PageLink.query_broken().all()
+    return render_template('broken_links.html', links=links)
+
+
+@app.route('/orphan-pages', methods=['GET'])
+@login_required
+def orphan_pages():
+    query = PageLink.query_orphans(include_private=True)
+    pager = KeysetPager.from_request(query)
+    return render_template('all_pages.html', pager=pager,
+                           page_links_endpoint='orphan_pages',
+                           page_links_args={})
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not Config.METRICS:
+        raise NotFound
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route("/logout")
@@ -562,7 +2698,9 @@ def cmd_create_db(_print=None):
         _print = print
     _print('Setting up the database')
     db.create_all()
-    if not User.query.all():
+    get_search_index().create()
+    db.session.commit()
+    if User.query.first() is None:
         chars = 'abcdefghijklmnopqrstuvwxyz' \
                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' \
                 '0123456789'
@@ -575,8 +2713,475 @@ def cmd_create_db(_print=None):
         db.session.commit()
 
 
+def precompile_templates():
+    # load every template, including custom overrides, so that they are
+    # compiled once before the workers are forked rather than by the first
+    # request of each worker
+    env = app.jinja_env
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+def ensure_db(_print=None):
+    # checked once before serving, so that a new database works without
+    # --create-db while workers and other commands do no schema work
+    table_names = set(inspect(db.engine).get_table_names())
+    if Page.__tablename__ not in table_names:
+        cmd_create_db(_print=_print)
+        return
+    # add the tables introduced by newer versions, including the search
+    # index, which is not part of the metadata
+    if not table_names.issuperset(db.metadata.tables):
+        db.create_all()
+    index = get_search_index()
+    index.create()
+    db.session.commit()
+    if index.TABLE is not None and index.TABLE not in table_names:
+        # the pages saved before the index existed are not in it yet
+        rebuild_search_index(_print=_print)
+
+
+def warm_render_cache(batch_size=100, _print=None):
+    if _print is None:
+        _print = print
+    page_ids = [page_id for page_id, in
+                db.session.query(Page.id).order_by(Page.id)]
+    _print('Rendering {} pages'.format(len(page_ids)))
+    for i in range(0, len(page_ids), batch_size):
+        batch = page_ids[i:i + batch_size]
+        existing = {}
+        for rendered in RenderedHtml.query.filter(
+                RenderedHtml.page_id.in_(batch)):
+            existing.setdefault(rendered.page_id, {})[rendered.field] = \
+                rendered
+        for page in Page.query.filter(Page.id.in_(batch)):
+            page.store_rendered_html(existing.get(page.id, {}))
+        db.session.commit()
+    _print('Done')
+
+
+def summarize_pages(page_ids):
+    changed = []
+    with app.app_context():
+        rows = db.session.query(Page.id, Page._content, Page.summary).filter(
+            Page.id.in_(page_ids))
+        for page_id, content, summary in rows:
+            new_summary = Page.summarize(content or '')
+            if new_summary != summary:
+                changed.append((page_id, new_summary))
+    return changed
+
+
+def reset_all_summaries(jobs=1, batch_size=500, _print=None):
+    if _print is None:
+        _print = print
+    page_ids = [page_id for page_id, in
+                db.session.query(Page.id).order_by(Page.id)]
+    _print('Resetting the summaries of {} pages'.format(len(page_ids)))
+    batches = [page_ids[i:i + batch_size]
+               for i in range(0, len(page_ids), batch_size)]
+    update = Page.__table__.update().where(
+        Page.__table__.c.id == db.bindparam('page_id')).values(
+        summary=db.bindparam('new_summary'))
+
+    def store(changed):
+        if changed:
+            db.session.execute(update, [
+                {'page_id': page_id, 'new_summary': summary}
+                for page_id, summary in changed])
+            db.session.commit()
+        return len(changed)
+
+    count = 0
+    for changed in map_batches(summarize_pages, batches, jobs):
+        count += store(changed)
+    if count and response_cache is not None:
+        response_cache.clear()
+    _print('Changed {} summaries'.format(count))
+    return count
+
+
+def rebuild_search_index(batch_size=100, _print=None):
+    if _print is None:
+        _print = print
+    index = get_search_index()
+    _print('Rebuilding the {} search index'.format(
+        type(index).__name__))
+    index.drop()
+    index.create()
+    page_ids = [page_id for page_id, in
+                db.session.query(Page.id).order_by(Page.id)]
+    for i in range(0, len(page_ids), batch_size):
+        batch = page_ids[i:i + batch_size]
+        index.index_pages(Page.query.options(
+            db.selectinload(Page.tags)).filter(Page.id.in_(batch)))
+        db.session.commit()
+        _print('Indexed {} of {} pages'.format(
+            min(i + batch_size, len(page_ids)), len(page_ids)))
+    db.session.commit()
+
+
+def list_jobs(_print=None):
+    if _print is None:
+        _print = print
+    counts = dict(db.session.query(Job.status, db.func.count(Job.id))
+                  .group_by(Job.status))
+    _print('Jobs: {} pending, {} running, {} failed'.format(
+        counts.get(Job.PENDING, 0), counts.get(Job.RUNNING, 0),
+        counts.get(Job.FAILED, 0)))
+    jobs = Job.query.order_by(Job.id).all()
+    for job in jobs:
+        _print('{:>8}  {:12}  page {:<8}  {:8}  {} attempts  {}'.format(
+            job.id, job.kind, job.page_id, job.status, job.attempts,
+            job.updated_date.isoformat(sep=' ', timespec='seconds')))
+        if job.error:
+            _print('          {}'.format(job.error))
+    return jobs
+
+
+def drain_jobs(_print=None):
+    if _print is None:
+        _print = print
+    retried = job_queue.retry()
+    if retried:
+        _print('Retrying {} failed or stale jobs'.format(retried))
+    count = job_queue.run_pending()
+    failed = Job.query.filter_by(status=Job.FAILED).count()
+    _print('Ran {} jobs, {} failed'.format(count, failed))
+    return count
+
+
+def rebuild_links(batch_size=100, _print=None):
+    if _print is None:
+        _print = print
+    page_ids = [page_id for page_id, in
+                db.session.query(Page.id).order_by(Page.id)]
+    _print('Finding the links in {} pages'.format(len(page_ids)))
+    for i in range(0, len(page_ids), batch_size):
+        batch = page_ids[i:i + batch_size]
+        existing = {}
+        for link in PageLink.query.filter(PageLink.source_id.in_(batch)):
+            existing.setdefault(link.source_id, {})[link.target_slug] = link
+        for page in Page.query.filter(Page.id.in_(batch)):
+            page.store_links(existing.get(page.id, {}))
+        db.session.commit()
+    if response_cache is not None:
+        response_cache.clear()
+    count = PageLink.query.count()
+    _print('Found {} links'.format(count))
+    return count
+
+
+class StaticPager(object):
+    order = 'title'
+    prev_cursor = None
+    next_cursor = None
+
+    def __init__(self, items):
+        self.items = items
+        self.per_page = len(items)
+        self.total = len(items)
+
+
+STATIC_MANIFEST = '.stuart-export.json'
+
+
+def is_in_memory_db():
+    url = db.engine.url
+    return url.drivername.startswith('sqlite') and \
+        url.database in (None, '', ':memory:')
+
+
+def render_static(path, template, **context):
+    base_url = 'http://localhost{}'.format(Config.PATH_PREFIX)
+    with app.test_request_context(path, base_url=base_url):
+        # static_export hides the links that need a running server, such
+        # as search, login and the listing order
+        return render_template(template, config=Config, static_export=True,
+                               **context)
+
+
+def write_static(directory, path, html):
+    path_dir = os.path.join(directory, path.strip('/'))
+    os.makedirs(path_dir, exist_ok=True)
+    with open(os.path.join(path_dir, 'index.html'), 'w',
+              encoding='utf-8') as f:
+        f.write(html)
+
+
+def export_static_pages(directory, page_ids):
+    exported = {}
+    with app.app_context():
+        pages = Page.query.options(db.selectinload(Page.tags)).filter(
+            Page.id.in_(page_ids))
+        for page in pages:
+            path = '/page/{}'.format(page.slug)
+            write_static(directory, path,
+                         render_static(path, 'page.html', page=page))
+            exported[str(page.id)] = {
+                'slug': page.slug,
+                'last_updated_date': page.last_updated_date.isoformat()}
+    return exported
+
+
+def init_worker():
+    # connections inherited from the parent process must not be shared
+    with app.app_context():
+        db.engine.dispose()
+
+
+def map_batches(fn, batches, jobs=1):
+    # yield fn(batch) for each batch in order, spreading the batches over
+    # forked worker processes when there is more than one of each
+    if jobs > 1 and len(batches) > 1 and not is_in_memory_db() and \
+            'fork' in multiprocessing.get_all_start_methods():
+        db.session.remove()
+        db.engine.dispose()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(jobs, mp_context=context,
+                                 initializer=init_worker) as pool:
+            yield from pool.map(fn, batches)
+    else:
+        for batch in batches:
+            yield fn(batch)
+
+
+def export_static_listings(directory):
+    main_page = Options.get_main_page()
+    page = Page.get_by_title(main_page) or Page.get_by_slug(main_page)
+    if page and page.is_private:
+        page = None
+    write_static(directory, '/', render_static('/', 'index.html', page=page))
+
+    listing = Page.query.options(Page.listing_columns()).filter(
+        Page.is_private.is_(False)).order_by(Page._title, Page.id)
+    write_static(directory, '/all-pages', render_static(
+        '/all-pages', 'all_pages.html', pager=StaticPager(listing.all()),
+        page_links_endpoint='all_pages', page_links_args={}))
+
+    tags = Tag.query_with_page_counts().all()
+    write_static(directory, '/tags',
+                 render_static('/tags', 'list_tags.html', tags=tags))
+    tag_ids = set(str(tag.id) for tag, page_count in tags)
+    for name in os.listdir(os.path.join(directory, 'tags')):
+        if name not in tag_ids and name != 'index.html':
+            shutil.rmtree(os.path.join(directory, 'tags', name),
+                          ignore_errors=True)
+    for tag, page_count in tags:
+        path = '/tags/{}'.format(tag.id)
+        pages = listing.filter(Page.tags.contains(tag)).all()
+        write_static(directory, path, render_static(
+            path, 'tag.html', tag=tag, pager=StaticPager(pages),
+            page_links_endpoint='get_tag',
+            page_links_args={'tag_id': tag.id}))
+
+    shutil.copytree(app.static_folder, os.path.join(directory, 'static'),
+                    dirs_exist_ok=True)
+    return len(tags)
+
+
+def export_static(directory, incremental=False, jobs=1, batch_size=100,
+                  _print=None):
+    if _print is None:
+        _print = print
+    manifest_path = os.path.join(directory, STATIC_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+    # site-wide settings appear on every page, so a change to any of them
+    # makes the whole previous export stale
+    signature = {'revision': get_revision(),
+                 'options': options_cache.load()}
+    previous = manifest.get('pages', {})
+    unchanged = previous
+    if not incremental or manifest.get('signature') != signature:
+        unchanged = {}
+
+    public = db.session.query(
+        Page.id, Page.slug, Page.last_updated_date).filter(
+        Page.is_private.is_(False)).order_by(Page.id).all()
+    current = {str(page_id): {'slug': slug,
+                              'last_updated_date': date.isoformat()}
+               for page_id, slug, date in public}
+    page_ids = [int(page_id) for page_id, entry in current.items()
+                if unchanged.get(page_id) != entry]
+    for page_id, entry in previous.items():
+        if current.get(page_id, {}).get('slug') != entry['slug']:
+            shutil.rmtree(os.path.join(directory, 'page', entry['slug']),
+                          ignore_errors=True)
+    _print('Exporting {} of {} public pages to {}'.format(
+        len(page_ids), len(current), directory))
+
+    batches = [page_ids[i:i + batch_size]
+               for i in range(0, len(page_ids), batch_size)]
+    for exported in map_batches(
+            functools.partial(export_static_pages, directory), batches, jobs):
+        _print('Exported {} pages'.format(len(exported)))
+
+    # keep one app context for all of the listings, so that rendering each
+    # file does not tear down the session holding the tags
+    with app.app_context():
+        tag_count = export_static_listings(directory)
+    _print('Exported {} tags'.format(tag_count))
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'signature': signature, 'pages': current}, f)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def format_date(value):
+    return value.isoformat() if value is not None else None
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def export_pages(f, chunk_size=500):
+    for option in Option.query.order_by(Option.name):
+        f.write(json.dumps({'type': 'option', 'name': option.name,
+                            'value': option.value}) + '\n')
+    rows = db.session.query(
+        Page.id, Page._title, Page.slug, Page._content, Page.notes,
+        Page.date, Page.last_updated_date, Page.is_private).order_by(
+        Page.id).yield_per(chunk_size)
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        tag_names = {}
+        for page_id, name in db.session.query(
+                tags_table.c.page_id, Tag.name).join(
+                Tag, Tag.id == tags_table.c.tag_id).filter(
+                tags_table.c.page_id.in_([row.id for row in chunk])):
+            tag_names.setdefault(page_id, []).append(name)
+        for row in chunk:
+            f.write(json.dumps({
+                'type': 'page',
+                'title': row._title,
+                'slug': row.slug,
+                'content': row._content,
+                'notes': row.notes,
+                'date': format_date(row.date),
+                'last_updated_date': format_date(row.last_updated_date),
+                'is_private': row.is_private,
+                'tags': sorted(tag_names.get(row.id, [])),
+            }) + '\n')
+        count += len(chunk)
+    return count
+
+
+def import_pages(f, chunk_size=500, _print=None):
+    if _print is None:
+        _print = print
+    records = (json.loads(line) for line in f if line.strip())
+    count = 0
+    for chunk in chunked(records, chunk_size):
+        for record in chunk:
+            if record['type'] == 'option':
+                option = Option.query.get(record['name'])
+                if option is None:
+                    option = Option(record['name'], record['value'])
+                option.value = record['value']
+                db.session.add(option)
+        pages = [record for record in chunk if record['type'] == 'page']
+        if pages:
+            import_page_chunk(pages)
+        db.session.commit()
+        count += len(pages)
+        _print('Imported {} pages'.format(count))
+    options_cache.invalidate()
+    if response_cache is not None:
+        response_cache.clear()
+    return count
+
+
+def import_page_chunk(records):
+    bases = [slugify(record.get('slug') or record['title'])
+             for record in records]
+    taken = Page.get_taken_slugs(bases)
+    rows = []
+    for record, base in zip(records, bases):
+        date = parse_date(record.get('date')) or datetime.now()
+        content = record.get('content') or ''
+        rows.append({
+            'title': record['title'],
+            'slug': Page.allocate_slug(base, taken),
+            'content': content,
+            'summary': Page.summarize(content),
+            'notes': record.get('notes'),
+            'date': date,
+            'last_updated_date':
+                parse_date(record.get('last_updated_date')) or date,
+            'is_private': bool(record.get('is_private')),
+        })
+    db.session.execute(Page.__table__.insert(), rows)
+
+    ids_by_slug = dict(db.session.query(Page.slug, Page.id).filter(
+        Page.slug.in_([row['slug'] for row in rows])))
+    tags_by_name = {tag.name: tag for tag in Tag.resolve(
+        name for record in records for name in record.get('tags', ()))}
+    links = [{'page_id': ids_by_slug[row['slug']],
+              'tag_id': tags_by_name[name].id}
+             for record, row in zip(records, rows)
+             for name in set(record.get('tags', ()))]
+    if links:
+        db.session.execute(tags_table.insert(), links)
+
+    get_search_index().index_pages(Page.query.options(
+        db.selectinload(Page.tags)).filter(
+        Page.id.in_(ids_by_slug.values())))
+
+
 def hash_password(unhashed_password):
-    return bcrypt.generate_password_hash(unhashed_password)
+    start = time.perf_counter()
+    hashed_password = bcrypt.generate_password_hash(
+        unhashed_password, rounds=Config.BCRYPT_ROUNDS)
+    bcrypt_seconds.observe(time.perf_counter() - start, operation='hash')
+    return hashed_password
+
+
+def check_password(hashed_password, password):
+    start = time.perf_counter()
+    result = bcrypt.check_password_hash(hashed_password, password)
+    bcrypt_seconds.observe(time.perf_counter() - start, operation='check')
+    return result
+
+
+def get_hash_rounds(hashed_password):
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode('utf-8')
+    try:
+        return int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def benchmark_hash(target_ms=250, _print=None):
+    if _print is None:
+        _print = print
+    chosen = 4
+    for rounds in range(4, 32):
+        start = time.perf_counter()
+        bcrypt.generate_password_hash('benchmark password', rounds=rounds)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        _print('{:2d} rounds: {:8.1f}ms'.format(rounds, elapsed_ms))
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+    _print('Use --bcrypt-rounds {} for hashes that take at most {:g}ms'.format(
+        chosen, target_ms))
+    return chosen
 
 
 def reset_slug(page_id):
@@ -586,12 +3191,33 @@ def reset_slug(page_id):
         raise NotFound(msg)
     print('Resetting the slug for page {}'.format(page_id))
     print('Old slug is "{}"'.format(page.slug))
+    old_slug = page.slug
     page.slug = page.get_unique_slug(page.title)
     db.session.add(page)
+    paths = set()
+    if response_cache is not None:
+        # collected before the commit expires the page and its tags
+        paths = page_response_paths(page) | {'/all-pages'}
+        paths |= {'/page/{}'.format(old_slug)}
+        paths |= main_page_response_paths(old_slug, page.slug)
+        paths |= tag_response_paths(page.tags)
     db.session.commit()
+    invalidate_responses(paths)
     print('New slug is "{}"'.format(page.slug))
 
 
+def trust_proxies(count):
+    # behind reverse proxies, remote_addr is the address of the nearest
+    # proxy; take the client's address from the X-Forwarded-For header
+    # instead, so that login attempts are limited per client rather than
+    # for everyone behind the proxy. Only the last count addresses in the
+    # header are trusted, since a client can send any header it likes.
+    if count > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count)
+
+
+trust_proxies(Config.PROXY_COUNT)
+
 if Config.PATH_PREFIX:
     gapp = DispatcherMiddleware(Flask('Dummy-app'), {
         Config.PATH_PREFIX: app
@@ -600,8 +3226,57 @@ else:
     gapp = app
 
 
+def post_fork(server, worker):
+    # connections opened by the main process must not be shared with the
+    # workers
+    db.get_engine(app).dispose()
+    # threads do not survive the fork, so each worker starts its own pool;
+    # as in run(), not for an in-memory database, whose single connection
+    # the threads of the pool would share
+    if not is_in_memory_db():
+        job_queue.start(Config.JOB_THREADS)
+
+
+def get_server_options():
+    return {
+        'bind': '{}:{}'.format(Config.HOST, Config.PORT),
+        'workers': Config.WORKERS,
+        'threads': Config.THREADS,
+        'keepalive': Config.KEEPALIVE,
+        'backlog': Config.BACKLOG,
+        'graceful_timeout': Config.GRACEFUL_TIMEOUT,
+        'preload_app': True,
+        'post_fork': post_fork,
+    }
+
+
+def run_workers(application):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ConfigError('Serving with --workers requires gunicorn.')
+
+    class StuartApplication(BaseApplication):
+        def load_config(self):
+            for name, value in get_server_options().items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return application
+
+    StuartApplication().run()
+
+
+def print_options_cache_delay(_print=None):
+    if _print is None:
+        _print = print
+    if Config.OPTIONS_CACHE_TTL > 0:
+        _print('Running servers will use the new value within {:g} seconds, '
+               'see --options-cache-ttl'.format(Config.OPTIONS_CACHE_TTL))
+
+
 def run():
-    print('__revision__: {}'.format(__revision__))
+    print('__revision__: {}'.format(get_revision()))
     print('Site name: {}'.format(Config.SITENAME))
     print('Path prefix: {}'.format(Config.PATH_PREFIX))
     print('Host: {}'.format(Config.HOST))
@@ -615,11 +3290,21 @@ def run():
         print(f"Effective DB URI: {db_uri}")
         print('Secret Key: {}'.format(Config.SECRET_KEY))
     print('Local Resources: {}'.format(Config.LOCAL_RESOURCES))
+    if Config.WORKERS:
+        print('Workers: {}'.format(Config.WORKERS))
+        print('Threads: {}'.format(Config.THREADS))
+        if Config.WORKERS > 1 and Config.RESPONSE_CACHE == 'memory':
+            print('Warning: each worker has its own memory response cache, '
+                  'and a change made in one worker is not seen by the '
+                  'others for up to {} seconds. Use --response-cache '
+                  'filesystem instead.'.format(Config.RESPONSE_CACHE_TTL))
 
     if args.create_db:
         cmd_create_db()
     elif args.hash_password is not None:
         print(hash_password(args.hash_password))
+    elif args.benchmark_hash is not None:
+        benchmark_hash(args.benchmark_hash)
     elif args.reset_slug is not None:
         try:
             reset_slug(args.reset_slug)
@@ -636,6 +3321,8 @@ def run():
         page.date = dateutil.parser.parse(new_date)
         db.session.add(page)
         db.session.commit()
+        invalidate_responses(page_response_paths(page) | {'/all-pages'} |
+                             tag_response_paths(page.tags))
         print('New date is "{}"'.format(page.date))
     elif args.set_last_updated_date is not None:
         page_id, new_date = args.set_last_updated_date
@@ -648,6 +3335,7 @@ def run():
         page.last_updated_date = dateutil.parser.parse(new_date)
         db.session.add(page)
         db.session.commit()
+        invalidate_responses(page_response_paths(page))
         print('New last updated date is "{}"'.format(page.last_updated_date))
     elif args.reset_summary is not None:
         page_id = args.reset_summary
@@ -657,10 +3345,24 @@ def run():
             exit(1)
         print('Resetting the summary for page {}'.format(page_id))
         print('Old summary is "{}"'.format(page.summary))
-        page.content = page.content
+        page.summary = Page.summarize(page.content or '')
         db.session.add(page)
+        get_search_index().index_pages([page])
         db.session.commit()
+        invalidate_responses({'/all-pages'})
         print('New summary is "{}"'.format(page.summary))
+    elif args.reset_all_summaries:
+        reset_all_summaries(jobs=Config.JOBS)
+    elif args.warm_render_cache:
+        warm_render_cache()
+    elif args.rebuild_search_index:
+        rebuild_search_index()
+    elif args.rebuild_links:
+        rebuild_links()
+    elif args.list_jobs:
+        list_jobs()
+    elif args.drain_jobs:
+        drain_jobs()
     elif args.list_options is not None:
         search_term = '%{}%'.format(args.list_options)
         query = Option.query.order_by(Option.name.asc())
@@ -688,7 +3390,10 @@ def run():
             option = Option(name, value)
         db.session.add(option)
         db.session.commit()
+        if response_cache is not None:
+            response_cache.clear()
         print('New value is "{}"'.format(option.value))
+        print_options_cache_delay()
     elif args.clear_option is not None:
         name = args.clear_option
         option = Option.query.get(name)
@@ -699,20 +3404,50 @@ def run():
         print('Old value is "{}"'.format(option.value))
         db.session.delete(option)
         db.session.commit()
+        if response_cache is not None:
+            response_cache.clear()
+        print_options_cache_delay()
+    elif args.export_static is not None:
+        export_static(args.export_static, incremental=args.incremental,
+                      jobs=Config.JOBS)
+    elif args.export_pages is not None:
+        with open(args.export_pages, 'w', encoding='utf-8') as f:
+            count = export_pages(f, chunk_size=args.chunk_size)
+        print('Exported {} pages'.format(count))
+    elif args.import_pages is not None:
+        with open(args.import_pages, encoding='utf-8') as f:
+            import_pages(f, chunk_size=args.chunk_size)
     elif args.create_user is not None:
         email, password = args.create_user
         hashed_password = hash_password(password)
         user = User(email=email, hashed_password=hashed_password)
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
         print(f'Created user with email {email}')
+    elif Config.WORKERS > 0:
+        if is_in_memory_db():
+            # each worker would get its own empty in-memory database
+            raise ConfigError('Serving with --workers requires a database '
+                              'that all workers can share, not an '
+                              'in-memory database. Set --db-uri.')
+        ensure_db()
+        if Config.PRODUCTION:
+            precompile_templates()
+        run_workers(gapp)
     else:
+        ensure_db()
+        if Config.PRODUCTION:
+            precompile_templates()
+        if not is_in_memory_db():
+            # the threads of the pool would share the single connection to
+            # an in-memory database
+            job_queue.start(Config.JOB_THREADS)
         run_simple(hostname=Config.HOST, port=Config.PORT,
                    application=gapp,
                    use_debugger=Config.DEBUG, use_reloader=Config.DEBUG,
                    passthrough_errors=True)
 
 
-cmd_create_db()
 if __name__ == "__main__":
     run()